@@ -0,0 +1,167 @@
+"""Async HTTP service over the core transcribe-and-analyze pipeline.
+
+    python api.py --host 0.0.0.0 --port 8000
+
+Each process is stateless apart from the shared response cache, so
+workers can be scaled horizontally behind a load balancer (for example
+with gunicorn's aiohttp.GunicornWebWorker and api:create_app).
+"""
+
+import argparse
+import asyncio
+import contextvars
+import functools
+import io
+import json
+import os
+import wave
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+import core
+
+MAX_UPLOAD_BYTES = int(os.getenv("API_MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+
+# Keep Persian text readable in responses
+json_response = functools.partial(web.json_response, dumps=functools.partial(json.dumps, ensure_ascii=False))
+
+
+# ============================================
+# HELPERS
+# ============================================
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking pipeline call on the default thread pool"""
+    loop = asyncio.get_running_loop()
+    # Carry the bound consultation trace over to the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, lambda: context.run(func, *args, **kwargs))
+
+
+async def read_symptoms(request):
+    """Extract the symptoms text from a JSON body or raise 400"""
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Body must be JSON")
+    symptoms = body.get("symptoms") if isinstance(body, dict) else None
+    if not isinstance(symptoms, str) or not symptoms.strip():
+        raise web.HTTPBadRequest(reason="'symptoms' must be a non-empty string")
+    return symptoms.strip(), body
+
+
+def upstream_error(e):
+    return json_response({"error": f"{type(e).__name__}: {e}"}, status=502)
+
+
+# ============================================
+# ENDPOINTS
+# ============================================
+
+async def health(request):
+    return json_response({
+        "status": "ok",
+        "scheduler": core.get_scheduler().stats(),
+        "single_flight": core.get_single_flight().stats(),
+        "token_usage": core.get_usage_ledger().stats(),
+    })
+
+
+async def metrics(request):
+    """Prometheus scrape endpoint (empty unless METRICS=1)"""
+    return web.Response(text=core.get_metrics().render(), content_type="text/plain", charset="utf-8")
+
+
+async def upload_audio(request):
+    """POST a WAV recording (multipart field "file" or raw body); returns transcript and analysis"""
+    if request.content_type.startswith("multipart/"):
+        reader = await request.multipart()
+        field = await reader.next()
+        while field is not None and field.name != "file":
+            field = await reader.next()
+        if field is None:
+            raise web.HTTPBadRequest(reason="Missing multipart field 'file'")
+        data = await field.read()
+    else:
+        data = await request.read()
+    if not data:
+        raise web.HTTPBadRequest(reason="Empty audio upload")
+
+    metrics = core.get_metrics()
+    trace = metrics.new_trace()
+    try:
+        with metrics.bound(trace):
+            try:
+                symptoms, prepared, vad = await run_blocking(core.transcribe_wav, io.BytesIO(data))
+            except (EOFError, KeyError, ValueError, wave.Error) as e:
+                # EOFError and KeyError from a truncated file have no message
+                detail = " ".join(str(e).split()) or "truncated or malformed file"
+                raise web.HTTPBadRequest(reason=f"Unreadable WAV audio ({type(e).__name__}): {detail}")
+            except Exception as e:
+                return upstream_error(e)
+            if not symptoms.strip():
+                return json_response({"error": "No speech recognised"}, status=422)
+
+            try:
+                result = await run_blocking(core.analyze_symptoms, symptoms.strip(), raise_errors=True)
+            except Exception as e:
+                return upstream_error(e)
+    finally:
+        metrics.finish_trace(trace)
+    result["audio_seconds"] = vad.original_seconds
+    result["speech_seconds"] = round(prepared.seconds, 2)
+    return json_response(result)
+
+
+async def analyze_text(request):
+    """POST {"symptoms": ..., "structured": true}; returns the analysis and triage"""
+    symptoms, body = await read_symptoms(request)
+    metrics = core.get_metrics()
+    trace = metrics.new_trace()
+    try:
+        with metrics.bound(trace):
+            result = await run_blocking(
+                core.analyze_symptoms,
+                symptoms,
+                structured=bool(body.get("structured", True)),
+                raise_errors=True
+            )
+    except Exception as e:
+        return upstream_error(e)
+    finally:
+        metrics.finish_trace(trace)
+    return json_response(result)
+
+
+async def doctor_questions(request):
+    """POST {"symptoms": ...}; returns the follow-up questions for the doctor"""
+    symptoms, _ = await read_symptoms(request)
+    prompt = core.format_prompt(core.DOCTOR_QUESTIONS_PROMPT, symptoms=symptoms)
+    try:
+        questions = await run_blocking(core.ask_model, prompt, raise_errors=True)
+    except Exception as e:
+        return upstream_error(e)
+    return json_response({"symptoms": symptoms, "questions": questions})
+
+
+def create_app():
+    """Build the aiohttp application"""
+    load_dotenv()
+    app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+    app.add_routes([
+        web.get("/health", health),
+        web.get("/metrics", metrics),
+        web.post("/v1/upload-audio", upload_audio),
+        web.post("/v1/analyze-text", analyze_text),
+        web.post("/v1/doctor-questions", doctor_questions),
+    ])
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="voice2doc HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    options = parser.parse_args()
+    web.run_app(create_app(), host=options.host, port=options.port)
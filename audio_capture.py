@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+
+# ============================================
+# STREAMING AUDIO CAPTURE
+# ============================================
+
+
+def sounddevice_stream(samplerate, channels, blocksize, dtype, callback):
+    """Open a real microphone InputStream (sounddevice is imported lazily)"""
+    import sounddevice as sd
+    return sd.InputStream(
+        samplerate=samplerate,
+        channels=channels,
+        blocksize=blocksize,
+        dtype=dtype,
+        callback=callback
+    )
+
+
+class FakeInputStream:
+    """Stand-in for sounddevice.InputStream that is fed synthetic blocks"""
+
+    def __init__(self, samplerate, channels, blocksize, dtype, callback):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.dtype = dtype
+        self.callback = callback
+        self.active = False
+
+    def start(self):
+        self.active = True
+
+    def stop(self):
+        self.active = False
+
+    def close(self):
+        self.active = False
+
+    def feed(self, block, status=None):
+        """Deliver one block of shape (frames, channels) to the callback"""
+        if self.active:
+            block = np.asarray(block, dtype=self.dtype).reshape(-1, self.channels)
+            self.callback(block, len(block), None, status)
+
+
+class AudioCapture:
+    """Record microphone input into preallocated fixed-size chunks
+
+    The InputStream callback copies each block into the current chunk and a
+    new chunk is allocated only when it fills up, so memory grows with the
+    actual recording length. Stopping just closes the stream; the number of
+    recorded frames is always known exactly. on_block, if given, receives a
+    copy of every recorded block (e.g. for incremental transcription).
+    """
+
+    def __init__(self, samplerate=44100, channels=1, max_seconds=300,
+                 blocksize=1024, chunk_seconds=1.0, dtype="float32",
+                 stream_factory=sounddevice_stream, on_block=None):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.max_frames = int(max_seconds * samplerate)
+        self.blocksize = blocksize
+        self.chunk_frames = max(int(chunk_seconds * samplerate), blocksize)
+        self.dtype = dtype
+        self.stream_factory = stream_factory
+        self.on_block = on_block
+        self.frames_written = 0
+        self.truncated = False
+        self.overflowed = False
+        self.stream = None
+        self._chunks = []
+        self._lock = threading.Lock()
+
+    @property
+    def seconds(self):
+        """Duration of the audio recorded so far"""
+        return self.frames_written / self.samplerate
+
+    @property
+    def active(self):
+        return self.stream is not None
+
+    def start(self):
+        """Open the input stream and begin recording"""
+        self.stream = self.stream_factory(
+            self.samplerate, self.channels, self.blocksize, self.dtype, self._callback
+        )
+        self.stream.start()
+        return self.stream
+
+    def stop(self):
+        """Stop recording; cheap regardless of how much was captured"""
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            stream.stop()
+            stream.close()
+
+    def _callback(self, indata, frames, time_info, status):
+        if status:
+            self.overflowed = True
+        with self._lock:
+            remaining = self.max_frames - self.frames_written
+            if remaining <= 0:
+                self.truncated = True
+                return
+            if frames > remaining:
+                frames = remaining
+                self.truncated = True
+            offset = 0
+            while offset < frames:
+                position = self.frames_written % self.chunk_frames
+                if position == 0:
+                    self._chunks.append(
+                        np.empty((self.chunk_frames, self.channels), dtype=self.dtype)
+                    )
+                count = min(frames - offset, self.chunk_frames - position)
+                self._chunks[-1][position:position + count] = indata[offset:offset + count]
+                offset += count
+                self.frames_written += count
+        if self.on_block is not None:
+            self.on_block(indata[:frames].copy())
+
+    def get_audio(self):
+        """Return the recorded frames as one (frames, channels) array"""
+        with self._lock:
+            if not self._chunks:
+                return np.zeros((0, self.channels), dtype=self.dtype)
+            return np.concatenate(self._chunks)[:self.frames_written]
+
+    def reset(self):
+        """Discard recorded audio so the capture can be reused"""
+        with self._lock:
+            self._chunks = []
+            self.frames_written = 0
+            self.truncated = False
+            self.overflowed = False
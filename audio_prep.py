@@ -0,0 +1,132 @@
+import io
+import math
+import wave
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:  # FLAC/Opus output is optional
+    soundfile = None
+
+# ============================================
+# AUDIO PREPARATION
+# ============================================
+
+TARGET_SAMPLE_RATE = 16000  # What speech recognition actually needs
+
+CONTAINERS = {
+    "wav": ("voice.wav", "audio/wav"),
+    "flac": ("voice.flac", "audio/flac"),
+    "opus": ("voice.ogg", "audio/ogg"),
+}
+
+
+class PreparedAudio(namedtuple("PreparedAudio", "data mime_type filename samplerate frames")):
+    """Encoded audio held in memory, ready for playback and upload"""
+
+    __slots__ = ()
+
+    @property
+    def seconds(self):
+        return self.frames / self.samplerate
+
+    def upload_file(self):
+        """File tuple accepted by the OpenAI client for multipart uploads"""
+        return (self.filename, self.data, self.mime_type)
+
+
+def load_wav(path):
+    """Read a PCM WAV file into a (frames, channels) float32 array and its rate"""
+    with wave.open(path, "rb") as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        samplerate = wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+    if width == 1:
+        data = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        data = ((b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)) << 8 >> 8) / float(2 ** 23)
+    else:
+        dtype = {2: np.int16, 4: np.int32}[width]
+        data = np.frombuffer(raw, dtype=dtype) / float(2 ** (8 * width - 1))
+    return data.astype(np.float32).reshape(-1, channels), samplerate
+
+
+def to_mono(audio):
+    """Average all channels into a 1-D float32 signal"""
+    audio = np.asarray(audio, dtype=np.float32)
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1, dtype=np.float32)
+    return audio
+
+
+def _polyphase_filters(up, down, half_taps):
+    """Windowed-sinc filter bank with one row per output phase"""
+    cutoff = min(1.0, up / down)
+    offsets = np.arange(-half_taps + 1, half_taps + 1)
+    frac = np.arange(up)[:, None] / up
+    x = frac - offsets[None, :]
+    window = 0.5 * (1 + np.cos(np.pi * np.clip(x / half_taps, -1, 1)))
+    filters = cutoff * np.sinc(cutoff * x) * window
+    # Normalize every phase to unity DC gain
+    filters /= filters.sum(axis=1, keepdims=True)
+    return offsets, filters.astype(np.float32)
+
+
+def resample(signal, orig_rate, target_rate=TARGET_SAMPLE_RATE, half_taps=16, block=65536):
+    """Resample a mono float signal with a rational polyphase filter"""
+    signal = np.asarray(signal, dtype=np.float32)
+    if orig_rate == target_rate or len(signal) == 0:
+        return signal
+    g = math.gcd(int(orig_rate), int(target_rate))
+    up, down = int(target_rate) // g, int(orig_rate) // g
+    offsets, filters = _polyphase_filters(up, down, half_taps)
+    padded = np.pad(signal, half_taps)
+    n_out = -(-len(signal) * up // down)
+    out = np.empty(n_out, dtype=np.float32)
+    for start in range(0, n_out, block):
+        position = np.arange(start, min(start + block, n_out), dtype=np.int64) * down
+        base, phase = np.divmod(position, up)
+        taps = padded[base[:, None] + offsets[None, :] + half_taps]
+        out[start:start + len(position)] = np.einsum("ij,ij->i", taps, filters[phase])
+    return out
+
+
+def to_int16(signal):
+    """Convert a float signal in [-1, 1] to int16 PCM"""
+    return (np.clip(signal, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def encode(pcm, samplerate, container="wav"):
+    """Encode int16 mono PCM into an in-memory container"""
+    buffer = io.BytesIO()
+    if container != "wav" and soundfile is not None:
+        if container == "flac":
+            soundfile.write(buffer, pcm, samplerate, format="FLAC", subtype="PCM_16")
+        else:
+            soundfile.write(buffer, pcm, samplerate, format="OGG", subtype="OPUS")
+    else:
+        container = "wav"
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(samplerate)
+            wav.writeframes(pcm.tobytes())
+    return buffer.getvalue(), container
+
+
+def prepare_audio(audio, samplerate, container="wav", target_rate=TARGET_SAMPLE_RATE):
+    """Downmix, resample to 16 kHz int16 and encode once, entirely in memory
+
+    container may be "wav", "flac" or "opus"; compressed containers need the
+    optional soundfile package and fall back to WAV without it.
+    """
+    if container not in CONTAINERS:
+        raise ValueError(f"Unsupported audio container: {container}")
+    pcm = to_int16(resample(to_mono(audio), samplerate, target_rate))
+    data, container = encode(pcm, target_rate, container)
+    filename, mime_type = CONTAINERS[container]
+    return PreparedAudio(data, mime_type, filename, target_rate, len(pcm))
@@ -0,0 +1,205 @@
+"""Headless batch runner for the transcribe-and-analyze pipeline.
+
+Reads WAV recordings from a directory or symptom texts from a JSONL file
+(one object per line with an "id" and a "symptoms" or "text" field), runs
+them with bounded concurrency under a request rate limit and appends one
+JSON result per line to the output file. Items already present in the
+output are skipped, so an interrupted run resumes where it stopped.
+
+    python batch.py recordings/ results.jsonl --concurrency 8 --rpm 120
+    python batch.py cases.jsonl results.jsonl
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+import core
+
+# ============================================
+# INPUTS AND CHECKPOINTING
+# ============================================
+
+
+def iter_inputs(path, text_field=None):
+    """Yield (item_id, kind, payload) lazily from a directory or JSONL file
+
+    A malformed JSONL line yields kind "invalid" with the error as payload,
+    keyed by its line number.
+    """
+    if os.path.isdir(path):
+        with os.scandir(path) as entries:
+            names = sorted(entry.name for entry in entries
+                           if entry.is_file() and entry.name.lower().endswith(".wav"))
+        for name in names:
+            yield name, "audio", os.path.join(path, name)
+        return
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("not a JSON object")
+            except ValueError as e:
+                # Reported as a failed item rather than aborting the run
+                yield str(line_number), "invalid", f"line {line_number}: {e}"
+                continue
+            text = record.get(text_field) if text_field else record.get("symptoms", record.get("text"))
+            yield str(record.get("id", line_number)), "text", text
+
+
+def load_checkpoint(output_path):
+    """Ids of items that already have a successful result in the output file"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by an interrupted run
+            if "error" not in record:
+                done.add(record["id"])
+    return done
+
+
+class RateLimiter:
+    """Space calls evenly to stay under a requests-per-minute budget"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# ============================================
+# PIPELINE
+# ============================================
+
+
+def process_item(item_id, kind, payload, limiter, options):
+    """Transcribe (for audio) and analyze one item, returning its result record"""
+    start = time.perf_counter()
+    record = {"id": item_id, "kind": kind}
+    try:
+        if kind == "invalid":
+            raise ValueError(payload)
+        if kind == "audio":
+            limiter.acquire()
+            symptoms, prepared, vad = core.transcribe_wav(payload, container=options.audio_format)
+            record["audio_seconds"] = vad.original_seconds
+            record["speech_seconds"] = round(prepared.seconds, 2)
+            record["transcription_seconds"] = round(time.perf_counter() - start, 3)
+        else:
+            symptoms = payload
+        if not symptoms or not symptoms.strip():
+            raise ValueError("empty symptoms")
+        limiter.acquire()
+        record.update(core.analyze_symptoms(
+            symptoms.strip(),
+            structured=not options.free_text,
+            use_cache=not options.no_cache,
+            raise_errors=True
+        ))
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["latency_seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = math.ceil(q / 100 * len(sorted_values))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def run(options):
+    done = load_checkpoint(options.output)
+    limiter = RateLimiter(options.rpm)
+    latencies = []
+    counts = {"ok": 0, "failed": 0, "skipped": 0}
+    started = time.perf_counter()
+
+    with open(options.output, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        pending = set()
+
+        def drain(block_until):
+            nonlocal pending
+            finished, pending = wait(pending, return_when=block_until)
+            for future in finished:
+                record = future.result()
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()  # each finished item is a durable checkpoint
+                latencies.append(record["latency_seconds"])
+                counts["failed" if "error" in record else "ok"] += 1
+
+        for item_id, kind, payload in iter_inputs(options.input, options.text_field):
+            if item_id in done:
+                counts["skipped"] += 1
+                continue
+            # Bound the number of items in flight so inputs are streamed
+            while len(pending) >= options.concurrency * 2:
+                drain(FIRST_COMPLETED)
+            pending.add(executor.submit(process_item, item_id, kind, payload, limiter, options))
+        while pending:
+            drain(FIRST_COMPLETED)
+
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    processed = counts["ok"] + counts["failed"]
+    return {
+        **counts,
+        "elapsed_seconds": round(elapsed, 2),
+        "items_per_second": round(processed / elapsed, 3) if elapsed else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch transcribe-and-analyze runner")
+    parser.add_argument("input", help="directory of .wav recordings or a JSONL file of symptom texts")
+    parser.add_argument("output", help="JSONL file results are appended to (also the checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=4, help="items processed in parallel")
+    parser.add_argument("--rpm", type=float, default=60, help="max upstream requests per minute (0 = unlimited)")
+    parser.add_argument("--text-field", help="JSONL field holding the symptoms (default: symptoms or text)")
+    parser.add_argument("--audio-format", default="wav", choices=["wav", "flac", "opus"])
+    parser.add_argument("--free-text", action="store_true", help="use the free-text analysis instead of JSON triage")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the response cache")
+    options = parser.parse_args(argv)
+
+    load_dotenv()
+    if not os.getenv("OPENAI_API_KEY") or not os.getenv("OPENAI_BASE_URL"):
+        parser.error("OPENAI_API_KEY and OPENAI_BASE_URL must be set (e.g. in .env)")
+
+    summary = run(options)
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
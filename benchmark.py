@@ -0,0 +1,299 @@
+"""Load test of the transcribe-then-analyze pipeline against a fake provider.
+
+Starts fake_openai.py on a local port (or uses --base-url), then runs N
+concurrent simulated sessions. Each session records synthetic speech,
+prepares and transcribes it, asks for the structured triage and streams
+the doctor's follow-up questions, exactly as the app does. Requests per
+second, p50/p95/p99 per stage and peak memory are written as JSON.
+
+    python benchmark.py --sessions 20 --cases 5 --output before.json
+    python benchmark.py --sessions 20 --cases 5 --output after.json --compare before.json
+
+Arguments after "--" are passed to the fake server, e.g.
+    python benchmark.py -- --error-rate 0.05 --chat-ttft lognormal:1.0,0.6
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import core
+from batch import percentile
+
+STAGES = ["prepare_audio", "transcription", "triage", "questions_first_token", "questions_total", "consultation"]
+
+
+# ============================================
+# SYNTHETIC AUDIO
+# ============================================
+
+
+def synthetic_speech(seconds, samplerate=44100, rng=None):
+    """Syllable-like voiced bursts separated by pauses over a low noise floor"""
+    rng = rng or np.random.default_rng()
+    n = int(seconds * samplerate)
+    t = np.arange(n, dtype=np.float32) / samplerate
+    pitch = rng.uniform(100, 220)
+    voice = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 5))
+    # 4 Hz syllable envelope, gated into phrases with pauses between them
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    phrase = (np.sin(2 * np.pi * t / rng.uniform(2.5, 4.0)) > -0.3).astype(np.float32)
+    audio = 0.3 * voice * envelope * phrase + rng.normal(0, 0.003, n)
+    return audio.astype(np.float32)
+
+
+# ============================================
+# HARNESS
+# ============================================
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_server(port, server_args):
+    """Launch fake_openai.py in a subprocess and wait until it accepts requests"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_openai.py")
+    process = subprocess.Popen([sys.executable, script, "--port", str(port), *server_args])
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=1)
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("fake_openai.py exited during startup")
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("fake_openai.py did not start")
+
+
+def server_stats(base_url):
+    root = base_url.rsplit("/v1", 1)[0]
+    try:
+        with urllib.request.urlopen(f"{root}/stats", timeout=5) as response:
+            return json.loads(response.read())
+    except OSError:
+        return None  # a real or third-party endpoint has no /stats
+
+
+class Recorder:
+    """Thread-safe stage timings and error counts"""
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def error(self, stage, e):
+        with self._lock:
+            key = f"{stage}: {type(e).__name__}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self):
+        stages = {}
+        for stage, values in self.samples.items():
+            values = sorted(values)
+            if not values:
+                continue
+            stages[stage] = {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 4),
+                "p50": round(percentile(values, 50), 4),
+                "p95": round(percentile(values, 95), 4),
+                "p99": round(percentile(values, 99), 4),
+                "max": round(values[-1], 4),
+            }
+        return stages
+
+
+def run_case(recorder, rng, options):
+    """One consultation: record, prepare, transcribe, triage and follow-up questions"""
+    use_cache = options.cache
+    started = time.perf_counter()
+    audio = synthetic_speech(options.audio_seconds, options.samplerate, rng)
+
+    stage_start = time.perf_counter()
+    prepared, _ = core.prepare_recording(audio, options.samplerate)
+    recorder.add("prepare_audio", time.perf_counter() - stage_start)
+
+    stage_start = time.perf_counter()
+    try:
+        text = core.transcribe_audio(prepared)
+    except Exception as e:
+        recorder.error("transcription", e)
+        return
+    recorder.add("transcription", time.perf_counter() - stage_start)
+
+    priority = "red_flag" if core.get_red_flag_matcher().match(text) else "patient"
+    stage_start = time.perf_counter()
+    try:
+        triage = core.ask_triage(text, use_cache=use_cache, raise_errors=True, priority=priority)
+    except Exception as e:
+        recorder.error("triage", e)
+        return
+    if triage is None:
+        recorder.error("triage", ValueError("invalid triage"))
+    recorder.add("triage", time.perf_counter() - stage_start)
+
+    prompt = core.doctor_panel_prompts(text)["questions"]
+    stage_start = time.perf_counter()
+    parts = []
+    for chunk in core.ask_model_stream(prompt, use_cache=use_cache, priority="follow_up"):
+        if not parts:
+            recorder.add("questions_first_token", time.perf_counter() - stage_start)
+        parts.append(chunk)
+    if core.is_model_error("".join(parts)):
+        recorder.error("questions", RuntimeError("model error"))
+        return
+    recorder.add("questions_total", time.perf_counter() - stage_start)
+    recorder.add("consultation", time.perf_counter() - started)
+
+
+def run_session(recorder, session, options):
+    rng = np.random.default_rng(None if options.seed is None else options.seed + session)
+    for _ in range(options.cases):
+        run_case(recorder, rng, options)
+        if options.think_time:
+            time.sleep(rng.exponential(options.think_time))
+
+
+def run(options, server_args):
+    process = None
+    base_url = options.base_url
+    if base_url is None:
+        port = free_port()
+        process = start_fake_server(port, server_args)
+        base_url = f"http://127.0.0.1:{port}/v1"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    # A throwaway cache so runs never read answers left by earlier runs
+    cache_dir = tempfile.mkdtemp(prefix="voice2doc-bench-")
+    os.environ["RESPONSE_CACHE_PATH"] = os.path.join(cache_dir, "response_cache.sqlite3")
+    for flag, env in (("rpm", "SCHEDULER_RPM"), ("tpm", "SCHEDULER_TPM"), ("concurrency", "SCHEDULER_CONCURRENCY")):
+        if getattr(options, flag) is not None:
+            os.environ[env] = str(getattr(options, flag))
+
+    recorder = Recorder()
+    try:
+        before = server_stats(base_url)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options.sessions, thread_name_prefix="session") as executor:
+            futures = [executor.submit(run_session, recorder, i, options) for i in range(options.sessions)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - started
+        after = server_stats(base_url)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    upstream = None
+    if before and after:
+        upstream = {key: after[key] - before[key] for key in
+                    ("requests", "chat", "streams", "transcriptions", "errors", "rate_limited")}
+    completed = len(recorder.samples["consultation"])
+    return {
+        "config": {
+            **{key: value for key, value in vars(options).items() if key not in ("output", "compare")},
+            "server_args": server_args,
+            "python": platform.python_version(),
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "consultations": completed,
+        "consultations_per_second": round(completed / elapsed, 3),
+        "requests_per_second": round(upstream["requests"] / elapsed, 3) if upstream else None,
+        "upstream": upstream,
+        "errors": recorder.errors,
+        "stages": recorder.summary(),
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "client": dict(core.get_model_client().stats),
+        "scheduler": core.get_scheduler().stats(),
+        "single_flight": core.get_single_flight().stats(),
+        "token_usage": core.get_usage_ledger().stats(),
+    }
+
+
+def compare(result, previous):
+    """Lines describing how stage latencies moved since a previous run"""
+    lines = []
+    for stage, now in result["stages"].items():
+        then = previous.get("stages", {}).get(stage)
+        if not then:
+            continue
+        deltas = ", ".join(
+            f"{q} {then[q]:.3f}->{now[q]:.3f}s ({(now[q] - then[q]) / then[q]:+.0%})" if then[q] else f"{q} {now[q]:.3f}s"
+            for q in ("p50", "p95", "p99")
+        )
+        lines.append(f"{stage}: {deltas}")
+    if previous.get("requests_per_second") and result.get("requests_per_second"):
+        lines.append(f"requests/s: {previous['requests_per_second']} -> {result['requests_per_second']}")
+    lines.append(f"peak RSS MB: {previous.get('peak_rss_mb')} -> {result['peak_rss_mb']}")
+    return lines
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    server_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, server_args = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(description="Load test against a fake OpenAI-compatible server")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent simulated sessions")
+    parser.add_argument("--cases", type=int, default=3, help="consultations per session")
+    parser.add_argument("--audio-seconds", type=float, default=15.0, help="length of each synthetic recording")
+    parser.add_argument("--samplerate", type=int, default=44100)
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between a session's cases")
+    parser.add_argument("--cache", action="store_true", help="let the response cache answer repeats")
+    parser.add_argument("--rpm", type=float, help="override SCHEDULER_RPM")
+    parser.add_argument("--tpm", type=float, help="override SCHEDULER_TPM")
+    parser.add_argument("--concurrency", type=int, help="override SCHEDULER_CONCURRENCY")
+    parser.add_argument("--base-url", help="use an already running server instead of starting fake_openai.py")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    options = parser.parse_args(argv)
+
+    result = run(options, server_args)
+    with open(options.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+
+    print(f"{result['consultations']} consultations in {result['elapsed_seconds']}s, "
+          f"{result['requests_per_second']} requests/s, peak RSS {result['peak_rss_mb']} MB", file=sys.stderr)
+    for stage, stats in result["stages"].items():
+        print(f"  {stage:<22} p50 {stats['p50']:.3f}s  p95 {stats['p95']:.3f}s  p99 {stats['p99']:.3f}s",
+              file=sys.stderr)
+    if result["errors"]:
+        print(f"  errors: {result['errors']}", file=sys.stderr)
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        for line in compare(result, previous):
+            print(f"  {line}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
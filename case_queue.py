@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from consultation_store import connect
+
+# ============================================
+# SHARED CASE QUEUE
+# ============================================
+
+QueuedCase = namedtuple(
+    "QueuedCase",
+    "id submitted symptoms triage urgency red_flags status claimed_by analysis triage_json"
+)
+
+# Lower sorts first: red flags or red triage, then yellow or not yet triaged, then green
+URGENCY = {"red": 0, "yellow": 1, None: 1, "green": 2}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT,
+    submitted REAL NOT NULL,
+    symptoms TEXT NOT NULL,
+    triage TEXT,
+    urgency INTEGER NOT NULL,
+    red_flags TEXT NOT NULL,
+    analysis TEXT,
+    triage_json TEXT,
+    status TEXT NOT NULL DEFAULT 'open',
+    claimed_by TEXT,
+    claimed_at REAL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cases_queue ON cases (status, urgency, submitted);
+"""
+
+_CASE_COLUMNS = "id, submitted, symptoms, triage, urgency, red_flags, status, claimed_by, analysis, triage_json"
+
+
+def urgency(triage=None, red_flags=()):
+    """Sort rank of a case from its triage level and matched red flags"""
+    return 0 if red_flags else URGENCY.get(triage, 1)
+
+
+class CaseQueue:
+    """Patient cases shared between sessions and processes through SQLite
+
+    Patients publish cases; doctors list open cases (most urgent first) and
+    claim one, which is an atomic conditional update, so two doctors never
+    take the same case. A claim is a lease: if the doctor never finishes or
+    releases the case, it reopens after claim_lease seconds.
+
+    Doctors learn about changes without querying the table: one watcher
+    thread per process polls PRAGMA data_version, which changes whenever
+    another connection (this process or another) commits, and bumps
+    version; it also bumps it when a claim's lease runs out. Sessions compare version with the value they last rendered,
+    or block in wait_for_change().
+    """
+
+    def __init__(self, path="cases.sqlite3", claim_lease=1800, poll_interval=0.5):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.claim_lease = claim_lease
+        self.poll_interval = poll_interval
+        self.version = 0
+        self._conn = connect(path)
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._stop = threading.Event()
+        self._watcher = threading.Thread(target=self._watch, name="case-queue-watcher", daemon=True)
+        self._watcher.start()
+
+    # Publishing
+
+    def publish(self, symptoms, triage=None, red_flags=(), analysis=None, triage_json=None, session_id=None):
+        """Add a patient case to the queue and return its id"""
+        now = time.time()
+        with self._lock, self._conn:
+            case_id = self._conn.execute(
+                "INSERT INTO cases (session_id, submitted, symptoms, triage, urgency, red_flags, analysis, "
+                "triage_json, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (session_id, now, symptoms, triage, urgency(triage, red_flags),
+                 json.dumps(list(red_flags), ensure_ascii=False), analysis, triage_json, now)
+            ).lastrowid
+        self._notify()
+        return case_id
+
+    def update(self, case_id, triage=None, analysis=None, triage_json=None):
+        """Attach the analysis (and triage level) once it is available"""
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT red_flags FROM cases WHERE id = ?", (case_id,)).fetchone()
+            if row is None:
+                return
+            self._conn.execute(
+                "UPDATE cases SET triage = ?, urgency = ?, analysis = ?, triage_json = ?, updated = ? "
+                "WHERE id = ?",
+                (triage, urgency(triage, json.loads(row[0])), analysis, triage_json, time.time(), case_id)
+            )
+        self._notify()
+
+    # Doctors
+
+    def pending(self, doctor_id=None, limit=50):
+        """Open cases and the doctor's own claims, most urgent and oldest first"""
+        expired = time.time() - self.claim_lease
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_CASE_COLUMNS} FROM cases "
+                "WHERE status = 'open' OR (status = 'claimed' AND (claimed_by = ? OR claimed_at < ?)) "
+                "ORDER BY urgency, submitted LIMIT ?",
+                (doctor_id, expired, limit)
+            ).fetchall()
+        return [self._case(row) for row in rows]
+
+    def get(self, case_id):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_CASE_COLUMNS} FROM cases WHERE id = ?", (case_id,)).fetchone()
+        return self._case(row) if row else None
+
+    def claim(self, case_id, doctor_id):
+        """Take a case; False if another doctor holds it"""
+        now = time.time()
+        with self._lock, self._conn:
+            claimed = self._conn.execute(
+                "UPDATE cases SET status = 'claimed', claimed_by = ?, claimed_at = ?, updated = ? "
+                "WHERE id = ? AND (status = 'open' OR (status = 'claimed' AND (claimed_by = ? OR claimed_at < ?)))",
+                (doctor_id, now, now, case_id, doctor_id, now - self.claim_lease)
+            ).rowcount
+        if claimed:
+            self._notify()
+        return bool(claimed)
+
+    def release(self, case_id, doctor_id):
+        """Put a claimed case back in the queue"""
+        return self._set_status(case_id, doctor_id, "open")
+
+    def close(self, case_id, doctor_id):
+        """Mark a claimed case as handled"""
+        return self._set_status(case_id, doctor_id, "closed")
+
+    def _set_status(self, case_id, doctor_id, status):
+        with self._lock, self._conn:
+            changed = self._conn.execute(
+                "UPDATE cases SET status = ?, claimed_by = NULL, claimed_at = NULL, updated = ? "
+                "WHERE id = ? AND status = 'claimed' AND claimed_by = ?",
+                (status, time.time(), case_id, doctor_id)
+            ).rowcount
+        if changed:
+            self._notify()
+        return bool(changed)
+
+    def counts(self):
+        """Open cases per urgency level"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT urgency, COUNT(*) FROM cases WHERE status = 'open' GROUP BY urgency"
+            ).fetchall()
+        return dict(rows)
+
+    def _case(self, row):
+        case = QueuedCase(*row)
+        return case._replace(red_flags=json.loads(case.red_flags))
+
+    # Change notification
+
+    def wait_for_change(self, seen, timeout=None):
+        """Block until version differs from seen; returns the current version"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != seen, timeout)
+            return self.version
+
+    def _notify(self):
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+
+    def _next_expiry(self, conn, after):
+        """When the oldest claim made after the given time runs out, or None"""
+        row = conn.execute(
+            "SELECT MIN(claimed_at) FROM cases WHERE status = 'claimed' AND claimed_at > ?", (after,)
+        ).fetchone()
+        return row[0] + self.claim_lease if row[0] is not None else None
+
+    def _watch(self):
+        # data_version only moves for commits made through other connections,
+        # so the watcher has its own and sees this process's writes too
+        conn = connect(self.path)
+        last = conn.execute("PRAGMA data_version").fetchone()[0]
+        # A lapsed lease reopens its case without any write, so the watcher
+        # also announces each claim's expiry; older ones were already visible
+        announced = time.time() - self.claim_lease
+        next_expiry = self._next_expiry(conn, announced)
+        while not self._stop.wait(self.poll_interval):
+            try:
+                current = conn.execute("PRAGMA data_version").fetchone()[0]
+                if current != last:
+                    last = current
+                    self._notify()
+                    next_expiry = self._next_expiry(conn, announced)
+                if next_expiry is not None and time.time() >= next_expiry:
+                    announced = next_expiry - self.claim_lease
+                    self._notify()
+                    next_expiry = self._next_expiry(conn, announced)
+            except Exception:
+                continue
+        conn.close()
+
+    def shutdown(self):
+        self._stop.set()
+        self._watcher.join()
+        self._conn.close()
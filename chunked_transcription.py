@@ -0,0 +1,138 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from audio_prep import TARGET_SAMPLE_RATE, prepare_audio, resample, to_mono
+from vad import trim_silence
+
+# ============================================
+# INCREMENTAL TRANSCRIPTION
+# ============================================
+
+PROMPT_CONTEXT_CHARS = 200  # Tail of the previous segment passed as context
+
+
+class SegmentsRejected(RuntimeError):
+    """Some segments failed the quality check, so the live transcript has gaps"""
+
+
+def make_executor(max_workers=3):
+    """Create the shared thread pool used for segment transcription"""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="transcribe")
+
+
+class IncrementalTranscriber:
+    """Transcribe a live recording segment by segment while it continues
+
+    feed() is called from the capture callback with every block. Once a
+    segment is at least min_seconds long and followed by pause_ms of
+    silence (or reaches max_seconds) it is cut and submitted to the
+    executor, so only the final segment is left when recording stops.
+    transcribe(prepared_audio, prompt) must return the segment text.
+
+    quality_check(audio, samplerate), if given, gates every segment
+    before upload and returns an audio_quality.QualityCheck: segments
+    without speech are skipped, unusable ones are skipped and their
+    problems collected in rejected (finish() then raises SegmentsRejected),
+    and corrected audio is what gets sent.
+    """
+
+    def __init__(self, transcribe, samplerate, executor, min_seconds=4.0,
+                 max_seconds=25.0, pause_ms=500, margin_db=10.0, min_energy=1e-5,
+                 quality_check=None):
+        self.transcribe = transcribe
+        self.samplerate = samplerate
+        self.executor = executor
+        self.quality_check = quality_check
+        self.rejected = []
+        self.min_frames = int(min_seconds * samplerate)
+        self.max_frames = int(max_seconds * samplerate)
+        self.pause_frames = int(pause_ms * samplerate / 1000)
+        self.margin = 10 ** (margin_db / 10)
+        self.min_energy = min_energy
+        self._blocks = []
+        self._frames = 0
+        self._silent_frames = 0
+        self._noise_floor = min_energy
+        self._futures = []
+        self._lock = threading.Lock()
+
+    @property
+    def submitted(self):
+        """Number of segments handed to the executor so far"""
+        return len(self._futures)
+
+    def feed(self, block):
+        """Append one captured block and cut a segment at a pause"""
+        energy = float(np.mean(np.square(block, dtype=np.float32)))
+        with self._lock:
+            # Slowly rising running minimum tracks the background noise level
+            if energy < self._noise_floor:
+                self._noise_floor = max(energy, self.min_energy / 100)
+            else:
+                self._noise_floor *= 1.01
+            threshold = max(self._noise_floor * self.margin, self.min_energy)
+
+            self._blocks.append(block)
+            self._frames += len(block)
+            if energy > threshold:
+                self._silent_frames = 0
+            else:
+                self._silent_frames += len(block)
+
+            at_pause = self._frames >= self.min_frames and self._silent_frames >= self.pause_frames
+            if at_pause or self._frames >= self.max_frames:
+                self._submit()
+
+    def finish(self):
+        """Submit the last segment and return the transcript in order
+
+        Raises SegmentsRejected once every segment has been gated if any
+        of them failed the quality check; the caller should transcribe the
+        whole recording instead.
+        """
+        with self._lock:
+            if self._frames:
+                self._submit()
+            futures = list(self._futures)
+        texts = [future.result() for future in futures]
+        if self.rejected:
+            raise SegmentsRejected(", ".join(sorted(set(self.rejected))))
+        return " ".join(text.strip() for text in texts if text and text.strip())
+
+    def cancel(self):
+        """Drop pending segments, e.g. when the recording is abandoned"""
+        with self._lock:
+            for future in self._futures:
+                future.cancel()
+            self._blocks, self._frames, self._silent_frames = [], 0, 0
+
+    def _submit(self):
+        previous = self._futures[-1] if self._futures else None
+        blocks, self._blocks = self._blocks, []
+        self._frames = 0
+        self._silent_frames = 0
+        self._futures.append(
+            self.executor.submit(self._transcribe_segment, blocks, previous)
+        )
+
+    def _transcribe_segment(self, blocks, previous):
+        signal = resample(to_mono(np.concatenate(blocks)), self.samplerate)
+        if self.quality_check is not None:
+            quality = self.quality_check(signal, TARGET_SAMPLE_RATE)
+            if quality.problems:
+                if quality.problems != ["no_speech"]:
+                    self.rejected.extend(quality.problems)
+                return ""
+            signal = quality.audio
+        vad = trim_silence(signal, TARGET_SAMPLE_RATE)
+        if vad.speech_ratio == 0:
+            return ""  # nothing worth paying for
+        # Use the previous segment's text as context only if it is already
+        # available; waiting for it would serialize the uploads.
+        prompt = None
+        if previous is not None and previous.done() and not previous.cancelled():
+            if previous.exception() is None:
+                prompt = previous.result()[-PROMPT_CONTEXT_CHARS:] or None
+        return self.transcribe(prepare_audio(vad.audio, TARGET_SAMPLE_RATE), prompt)
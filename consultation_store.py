@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from collections import namedtuple
+
+# ============================================
+# CONSULTATION STORE
+# ============================================
+
+# Lightweight row for history listings; the full analysis is fetched separately
+ConsultationSummary = namedtuple(
+    "ConsultationSummary",
+    "id timestamp role symptoms triage reviewed"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS consultations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT,
+    timestamp TEXT NOT NULL,
+    role TEXT NOT NULL,
+    symptoms TEXT NOT NULL,
+    triage TEXT,
+    triage_json TEXT,
+    analysis TEXT NOT NULL,
+    reviewed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS consultations_timestamp ON consultations (timestamp);
+CREATE INDEX IF NOT EXISTS consultations_role ON consultations (role, timestamp);
+CREATE INDEX IF NOT EXISTS consultations_session ON consultations (session_id, timestamp);
+"""
+
+_STOP = object()
+_FLUSH = object()
+
+log = logging.getLogger(__name__)
+
+
+def connect(path):
+    """Open a SQLite connection in WAL mode"""
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _filters(role=None, session_id=None):
+    """WHERE clause and parameters restricting rows to a role and/or session"""
+    clauses, params = [], []
+    if role:
+        clauses.append("role = ?")
+        params.append(role)
+    if session_id:
+        clauses.append("session_id = ?")
+        params.append(session_id)
+    return ("WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+class ConsultationStore:
+    """Durable consultation history in SQLite with batched background writes"""
+
+    def __init__(self, path="consultations.sqlite3", batch_size=50, flush_interval=0.5,
+                 retry_base=0.5, retry_cap=30.0):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._read_conn = connect(path)
+        self._read_conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._read_conn.execute("PRAGMA table_info(consultations)")}
+        if "reviewed" not in columns:
+            # Stores created before analyses could be marked as reviewed
+            self._read_conn.execute("ALTER TABLE consultations ADD COLUMN reviewed INTEGER NOT NULL DEFAULT 0")
+            self._read_conn.commit()
+        self._read_lock = threading.Lock()
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        # Set while a failed batch waits to be written again
+        self.last_error = None
+        self.unwritten = 0
+        self.write_failures = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="consultation-writer", daemon=True)
+        self._writer.start()
+
+    def add(self, consultation, session_id=None):
+        """Queue a consultation dict for writing"""
+        triage = consultation.get("triage")
+        self._queue.put((
+            session_id,
+            consultation["timestamp"],
+            consultation["role"],
+            consultation["symptoms"],
+            triage["triage"] if triage else None,
+            json.dumps(triage, ensure_ascii=False, separators=(",", ":")) if triage else None,
+            consultation["analysis"],
+        ))
+
+    def flush(self):
+        """Block until every queued consultation has been committed"""
+        if self._queue.unfinished_tasks:
+            self._queue.put(_FLUSH)  # cut the writer's batching wait short
+            self._queue.join()
+
+    def count(self, role=None, session_id=None):
+        """Number of stored consultations, optionally for one role or session"""
+        self.flush()
+        where, params = _filters(role, session_id)
+        with self._read_lock:
+            return self._read_conn.execute(f"SELECT COUNT(*) FROM consultations {where}", params).fetchone()[0]
+
+    def page(self, page=0, page_size=10, role=None, session_id=None):
+        """Newest-first page of consultation summaries without the analysis"""
+        self.flush()
+        where, params = _filters(role, session_id)
+        sql = (
+            "SELECT id, timestamp, role, symptoms, triage, reviewed FROM consultations "
+            f"{where} ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?"
+        )
+        with self._read_lock:
+            rows = self._read_conn.execute(sql, params + [page_size, page * page_size]).fetchall()
+        return [ConsultationSummary(*row) for row in rows]
+
+    def get_analysis(self, consultation_id):
+        """Fetch the full analysis and stored triage dict of one consultation"""
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT analysis, triage_json FROM consultations WHERE id = ?",
+                (consultation_id,)
+            ).fetchone()
+        if row is None:
+            return None, None
+        analysis, triage_json = row
+        return analysis, json.loads(triage_json) if triage_json else None
+
+    def get_summaries(self, consultation_ids):
+        """Summaries of the given consultations that still exist, by id"""
+        ids = [int(i) for i in consultation_ids]
+        if not ids:
+            return {}
+        placeholders = ", ".join("?" * len(ids))
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                "SELECT id, timestamp, role, symptoms, triage, reviewed FROM consultations "
+                f"WHERE id IN ({placeholders})",
+                ids
+            ).fetchall()
+        return {row[0]: ConsultationSummary(*row) for row in rows}
+
+    def symptoms_after(self, last_id, limit=1000):
+        """(id, symptoms) of consultations added after last_id, oldest first"""
+        with self._read_lock:
+            return self._read_conn.execute(
+                "SELECT id, symptoms FROM consultations WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, limit)
+            ).fetchall()
+
+    def set_reviewed(self, consultation_id, reviewed=True):
+        """Mark an analysis as checked by a doctor (or withdraw the mark)"""
+        with self._read_lock:
+            self._read_conn.execute(
+                "UPDATE consultations SET reviewed = ? WHERE id = ?", (int(reviewed), consultation_id)
+            )
+            self._read_conn.commit()
+
+    def clear(self, session_id=None):
+        """Delete the consultations of one session, or every one if no session is given"""
+        self.flush()
+        where, params = _filters(session_id=session_id)
+        with self._read_lock:
+            self._read_conn.execute(f"DELETE FROM consultations {where}", params)
+            self._read_conn.commit()
+
+    def close(self):
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._read_conn.close()
+
+    def _write_loop(self):
+        conn = connect(self.path)
+        retry, delay = [], self.retry_base
+        while True:
+            try:
+                # A failed batch is written again once its backoff has passed
+                batch = [self._queue.get(timeout=delay if retry else None)]
+            except queue.Empty:
+                batch = []
+            # Gather whatever else arrives within the flush interval
+            while batch and len(batch) < self.batch_size and batch[-1] is not _STOP and batch[-1] is not _FLUSH:
+                try:
+                    batch.append(self._queue.get(timeout=self.flush_interval))
+                except queue.Empty:
+                    break
+            rows = retry + [item for item in batch if item is not _STOP and item is not _FLUSH]
+            try:
+                if rows:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO consultations "
+                            "(session_id, timestamp, role, symptoms, triage, triage_json, analysis) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            rows
+                        )
+                if retry:
+                    log.info("Wrote %d consultations after retrying", len(rows))
+                retry, delay = [], self.retry_base
+                self.last_error, self.unwritten = None, 0
+            except sqlite3.Error as e:
+                # Keep the rows and try again with exponential backoff
+                delay = min(delay * 2, self.retry_cap) if retry else self.retry_base
+                retry = rows
+                self.last_error, self.unwritten = e, len(rows)
+                self.write_failures += 1
+                log.warning("Writing %d consultations failed (%s); retrying in %.1fs", len(rows), e, delay)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if batch and batch[-1] is _STOP:
+                if retry:
+                    log.error("Shutting down with %d consultations unwritten: %s", len(retry), self.last_error)
+                conn.close()
+                return
@@ -0,0 +1,110 @@
+import threading
+from collections import namedtuple
+
+from scheduler import estimate_tokens
+
+# ============================================
+# BOUNDED-CONTEXT CONVERSATION
+# ============================================
+
+# role is "patient" or "assistant"
+Turn = namedtuple("Turn", "role content")
+
+ROLE_LABELS = {"patient": "بیمار", "assistant": "پزشک"}
+
+
+def format_turns(turns):
+    """Render turns as labelled lines for a prompt or a transcript"""
+    return "\n".join(f"{ROLE_LABELS[turn.role]}: {turn.content}" for turn in turns)
+
+
+class Conversation:
+    """Follow-up dialogue sent to the model within a fixed token budget
+
+    The full transcript is kept for display, but each request carries only
+    a rolling clinical summary plus the turns after it. When the summary
+    and those turns outgrow token_budget, the older turns (all but the
+    last keep_turns) are folded into the summary; the fold sends just the
+    previous summary and the folded turns, so its cost is bounded too.
+    Folds can run in the background and are applied on the next turn.
+    """
+
+    def __init__(self, symptoms, analysis=None, token_budget=1500, keep_turns=4):
+        self.symptoms = symptoms
+        self.analysis = analysis
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.turns = []
+        self.summary = ""
+        self.summarized = 0  # turns[:summarized] are covered by the summary
+        self.folds = 0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def add(self, role, content):
+        with self._lock:
+            self.turns.append(Turn(role, content))
+
+    def recent(self):
+        """Turns sent verbatim with the next request"""
+        with self._lock:
+            return self.turns[self.summarized:]
+
+    def context_tokens(self):
+        """Estimated tokens of the summary and recent turns"""
+        with self._lock:
+            return estimate_tokens(self.summary) + sum(
+                estimate_tokens(turn.content) for turn in self.turns[self.summarized:]
+            )
+
+    def over_budget(self):
+        return self.context_tokens() > self.token_budget
+
+    def _plan_fold(self):
+        """(previous summary, turns to fold, end index), or None if nothing can be folded"""
+        with self._lock:
+            end = len(self.turns) - self.keep_turns
+            # Very long recent turns are folded too, always keeping the last one
+            while end < len(self.turns) - 1 and sum(
+                estimate_tokens(turn.content) for turn in self.turns[end:]
+            ) > self.token_budget // 2:
+                end += 1
+            if end <= self.summarized:
+                return None
+            return self.summary, self.turns[self.summarized:end], end
+
+    def _apply(self, summary, end):
+        with self._lock:
+            if end > self.summarized:
+                self.summary = summary
+                self.summarized = end
+                self.folds += 1
+
+    def compact(self, summarize, executor=None, wait=True):
+        """Fold old turns into the summary if the context is over budget
+
+        summarize(previous_summary, turns) returns the new summary. With an
+        executor the fold runs in the background; wait=True blocks until
+        the context is back within budget before the next request.
+        """
+        pending = self._pending
+        if pending is not None and (pending.done() or wait):
+            self._pending = None
+            try:
+                self._apply(*pending.result())
+            except Exception:
+                pass  # retried below while the context is still too large
+        if self._pending is not None or not self.over_budget():
+            return
+        plan = self._plan_fold()
+        if plan is None:
+            return
+        previous, turns, end = plan
+
+        def fold():
+            return summarize(previous, turns), end
+
+        if executor is not None and not wait:
+            self._pending = executor.submit(fold)
+        else:
+            self._apply(*fold())
@@ -0,0 +1,697 @@
+import functools
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from metrics import Metrics
+from model_client import ResilientClient
+from red_flags import DEFAULT_RULES_PATH, RedFlagMatcher
+from response_cache import ResponseCache, make_cache_key
+from scheduler import RequestScheduler, estimate_tokens
+from singleflight import SingleFlight
+from token_usage import UsageLedger, usage_counts
+from triage import TRIAGE_RESPONSE_FORMAT, parse_triage
+
+# Heavy dependencies (openai, numpy) are imported on first use so that
+# importing core stays cheap for workers and health checks.
+
+DEFAULT_MODEL = "gpt-4o-mini"
+TRANSCRIPTION_MODEL = "whisper-1"
+
+# Shown instead of an answer when the model could not be reached
+MODEL_ERROR_PREFIX = "❌ خطا در ارتباط با مدل"
+
+
+# ============================================
+# SHARED RESOURCES
+# ============================================
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """Create the OpenAI client once per process (reads OPENAI_API_KEY/OPENAI_BASE_URL)"""
+    from openai import OpenAI
+    # Retries are handled by the resilient client, not stacked in the SDK
+    return OpenAI(max_retries=0)
+
+
+@functools.lru_cache(maxsize=None)
+def get_model_client():
+    """Create the resilient call layer shared by all model requests"""
+    return ResilientClient(
+        get_client,
+        deadline=float(os.getenv("MODEL_DEADLINE", "60")),
+        attempt_timeout=float(os.getenv("MODEL_ATTEMPT_TIMEOUT", "20")),
+        transcription_deadline=float(os.getenv("TRANSCRIPTION_DEADLINE", "120")),
+        max_retries=int(os.getenv("MODEL_MAX_RETRIES", "3")),
+        hedge=os.getenv("MODEL_HEDGE", "0") == "1",
+        fallback_model=os.getenv("FALLBACK_MODEL") or None,
+        failure_threshold=int(os.getenv("CIRCUIT_FAILURES", "5")),
+        reset_timeout=float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_scheduler():
+    """Create the request scheduler every upstream call queues in"""
+    # Defaults match the provider's entry tier for gpt-4o-mini
+    return RequestScheduler(
+        rpm=float(os.getenv("SCHEDULER_RPM", "500")),
+        tpm=float(os.getenv("SCHEDULER_TPM", "200000")),
+        max_concurrency=int(os.getenv("SCHEDULER_CONCURRENCY", "8")),
+        aging_seconds=float(os.getenv("SCHEDULER_AGING_SECONDS", "10"))
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_single_flight():
+    """Create the registry that merges identical in-flight requests"""
+    return SingleFlight()
+
+
+@functools.lru_cache(maxsize=None)
+def get_usage_ledger():
+    """Create the per-call token usage ledger (TOKEN_USAGE_LOG appends JSONL)"""
+    return UsageLedger(log_path=os.getenv("TOKEN_USAGE_LOG") or None)
+
+
+@functools.lru_cache(maxsize=None)
+def get_metrics():
+    """Create the stage metrics registry (METRICS=1 to enable, TRACE_LOG for traces)"""
+    return Metrics(
+        enabled=os.getenv("METRICS", "0") == "1",
+        trace_log=os.getenv("TRACE_LOG") or None
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_response_cache():
+    """Create the model response cache once per process"""
+    return ResponseCache(
+        path=os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3"),
+        memory_entries=int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "256")),
+        disk_entries=int(os.getenv("RESPONSE_CACHE_DISK_ENTRIES", "5000")),
+        ttl=int(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_red_flag_matcher():
+    """Compile the red-flag rule set once per process"""
+    return RedFlagMatcher.from_file(os.getenv("RED_FLAG_RULES_PATH", DEFAULT_RULES_PATH))
+
+
+# ============================================
+# ENHANCED SYSTEM PROMPTS
+# ============================================
+
+# Each prompt is a static system message followed by a short user message
+# holding only the case data, so the provider can cache the long prefix.
+
+
+class PromptTemplate(namedtuple("PromptTemplate", "kind system user")):
+    """Static system instructions plus a small per-call user template"""
+
+    __slots__ = ()
+
+    def format(self, **kwargs):
+        return Prompt(self.kind, self.system, self.user.format(**kwargs))
+
+
+class Prompt(namedtuple("Prompt", "kind system user")):
+    """A formatted prompt, sent as a system and a user message"""
+
+    __slots__ = ()
+
+    @property
+    def messages(self):
+        return [{"role": "system", "content": self.system}, {"role": "user", "content": self.user}]
+
+    @property
+    def text(self):
+        return f"{self.system}\n\n{self.user}"
+
+
+class ConversationPrompt(namedtuple("ConversationPrompt", "kind system user turns")):
+    """A Prompt followed by the recent turns of a follow-up conversation"""
+
+    __slots__ = ()
+
+    @property
+    def messages(self):
+        roles = {"patient": "user", "assistant": "assistant"}
+        return Prompt(self.kind, self.system, self.user).messages + [
+            {"role": roles[turn.role], "content": turn.content} for turn in self.turns
+        ]
+
+    @property
+    def text(self):
+        return "\n\n".join([self.system, self.user] + [f"{turn.role}: {turn.content}" for turn in self.turns])
+
+
+PATIENT_ANALYSIS_PROMPT = PromptTemplate("patient_analysis", """
+شما یک سیستم هوش مصنوعی پزشکی پیشرفته هستید که به عنوان دستیار اورژانس عمل می‌کنید.
+علائم گزارش شده بیمار و زمان ثبت آن در پیام کاربر آمده است.
+
+## وظایف شما (به ترتیب اولویت):
+
+### 1️⃣ ارزیابی فوریت (TRIAGE)
+بر اساس پروتکل‌های استاندارد اورژانس، وضعیت را طبقه‌بندی کنید:
+
+🔴 **فوریت بحرانی (قرمز)**: نیاز به مراجعه فوری به اورژانس (0-1 ساعت)
+🟡 **فوریت متوسط (زرد)**: مراجعه به پزشک در 24 ساعت آینده
+🟢 **غیرفوری (سبز)**: قابل پیگیری با پزشک خانواده
+
+### 2️⃣ تشخیص‌های احتمالی (Differential Diagnosis)
+لیست 3-5 تشخیص محتمل با درصد احتمال به این صورت:
+
+**تشخیص اول (احتمال XX%):**
+- نام بیماری: [نام به فارسی و انگلیسی]
+- دلیل: [چرا این تشخیص محتمل است]
+- علائم کلیدی: [علائمی که با این بیماری همخوانی دارند]
+
+### 3️⃣ علائم خطر (Red Flags) ⚠️
+اگر هر یک از این علائم ظاهر شد، فوراً به اورژانس مراجعه کنید:
+- [لیست علائم خطرناک مرتبط]
+
+### 4️⃣ سوالات تکمیلی برای تشخیص دقیق‌تر
+برای تشخیص بهتر، لطفاً به این سوالات پاسخ دهید:
+1. [سوال مهم اول]
+2. [سوال مهم دوم]
+3. [سوال مهم سوم]
+
+### 5️⃣ توصیه‌های اولیه
+📌 اقدامات خانگی:
+- [توصیه 1]
+- [توصیه 2]
+
+💊 داروهای بدون نسخه (در صورت نیاز):
+- [دارو با دوز و هشدارها]
+
+🚫 موارد ممنوع:
+- [کارهایی که نباید انجام دهد]
+
+### 6️⃣ برنامه پیگیری
+- بررسی مجدد علائم در [مدت زمان]
+- در صورت بدتر شدن: [راهنمایی]
+
+---
+⚠️ **مهم:** این ارزیابی جایگزین معاینه پزشکی نیست.
+📊 **سطح اطمینان تحلیل:** [پایین/متوسط/بالا]
+""", """## اطلاعات بیمار:
+علائم گزارش شده: {symptoms}
+تاریخ و زمان: {timestamp}""")
+
+DOCTOR_QUESTIONS_PROMPT = PromptTemplate("doctor_questions", """
+شما یک پزشک متخصص با تجربه بالا هستید.
+علائم بیمار در پیام کاربر آمده است.
+
+## وظیفه:
+برای تشخیص دقیق، سوالات تکمیلی حرفه‌ای بپرسید.
+
+### قالب سوالات:
+
+**📋 بخش 1: تاریخچه دقیق علائم**
+1. **زمان شروع:** این علائم از چه زمانی شروع شده؟ آیا ناگهانی بوده؟
+2. **الگوی علائم:** دائمی است یا موقت؟ چه زمانی بدتر می‌شود؟
+
+**📋 بخش 2: شدت و کیفیت**
+3. **مقیاس شدت:** در مقیاس 1 تا 10 چقدر است؟
+4. **نوع احساس:** تیز، سوزاننده، فشاری، یا کند کننده؟
+
+**📋 بخش 3: عوامل تشدیدکننده**
+5. **چه چیزی وضعیت را بهتر/بدتر می‌کند؟**
+
+**📋 بخش 4: علائم همراه**
+6. **سایر علائم:** تب، لرز، تغییر اشتها، وزن، خواب؟
+
+**📋 بخش 5: سابقه پزشکی**
+7. **تاریخچه:** آیا قبلاً علائم مشابه داشته‌اید؟ بیماری زمینه‌ای؟ داروهای مصرفی؟
+
+**📋 بخش 6: سبک زندگی**
+8. **محیط:** سفر اخیر؟ تماس با بیماران؟ تغییر در رژیم غذایی؟
+
+---
+💡 **هدف:** با پاسخ به این سوالات، تشخیص دقیق‌تری ممکن می‌شود.
+""", """## اطلاعات موجود:
+علائم بیمار: {symptoms}""")
+
+EMERGENCY_PROTOCOL = PromptTemplate("emergency_protocol", """
+🚨 پروتکل اورژانس - ارزیابی سریع
+
+علائم بیمار در پیام کاربر آمده است.
+
+## ❗ بررسی فوری علائم خطرناک:
+
+### ⚠️ Red Flags (علائم خطر فوری):
+
+**قلبی-عروقی:**
+✋ درد قفسه سینه + تعریق → حمله قلبی احتمالی
+✋ تپش قلب شدید + بیهوشی
+
+**عصبی:**
+✋ فلج ناگهانی یک طرفه → سکته مغزی
+✋ سردرد رعدآسا شدید
+✋ اختلال هوشیاری
+
+**تنفسی:**
+✋ تنگی نفس شدید
+✋ کبودی لب‌ها
+✋ سرفه خونی
+
+**گوارشی:**
+✋ درد شکم ناگهانی و شدید
+✋ استفراغ خونی
+
+**سایر:**
+✋ خونریزی شدید
+✋ واکنش آلرژیک شدید
+✋ تب بالای 40 درجه
+
+## تصمیم‌گیری:
+
+**وجود علائم بالا:**
+🚨 تماس فوری با اورژانس 115
+
+**وضعیت پایدار:**
+📞 مشاوره پزشکی
+""", """علائم: {symptoms}""")
+
+REPORT_SUMMARY_PROMPT = PromptTemplate("report_summary", """
+شما یک پزشک متخصص هستید که گزارش جامع مشاوره را نهایی می‌کنید.
+علائم بیمار، تحلیل اولیه، سوالات تکمیلی و ارزیابی فوریت در پیام کاربر آمده است.
+
+## وظیفه:
+یک جمع‌بندی کوتاه برای پرونده بیمار بنویسید؛ بخش‌های موجود را تکرار نکنید.
+
+### قالب:
+**🩺 خلاصه وضعیت:** دو تا سه جمله
+**🔬 اقدامات تشخیصی پیشنهادی:** معاینه، آزمایش یا تصویربرداری لازم
+**📅 برنامه پیگیری:** زمان و شرایط مراجعه بعدی
+**⚠️ موارد نیازمند توجه فوری:** در صورت وجود
+""", """## علائم بیمار:
+{symptoms}
+
+## تحلیل اولیه:
+{analysis}
+
+## سوالات تکمیلی:
+{questions}
+
+## ارزیابی فوریت:
+{emergency}""")
+
+
+FOLLOW_UP_CHAT_PROMPT = PromptTemplate("follow_up_chat", """
+شما یک پزشک متخصص هستید که گفتگوی پیگیری با بیمار را ادامه می‌دهید.
+علائم اولیه، تحلیل اولیه و خلاصه بخش‌های قبلی گفتگو در پیام کاربر آمده است؛
+پیام‌های بعدی آخرین نوبت‌های گفتگو هستند.
+
+## وظیفه:
+- پاسخ‌های بیمار را در ارزیابی خود لحاظ کنید و در صورت تغییر، تحلیل را به‌روز کنید
+- در هر نوبت حداکثر 2 سوال تکمیلی مهم بپرسید
+- در صورت بروز علائم خطر، فوراً مراجعه به اورژانس 115 را توصیه کنید
+- کوتاه، روشن و به زبان فارسی پاسخ دهید
+
+⚠️ این گفتگو جایگزین معاینه پزشکی نیست.
+""", """## علائم اولیه بیمار:
+{symptoms}
+
+## تحلیل اولیه:
+{analysis}
+
+## خلاصه گفتگوی قبلی:
+{summary}""")
+
+CONVERSATION_SUMMARY_PROMPT = PromptTemplate("conversation_summary", """
+شما خلاصه بالینی یک گفتگوی پیگیری پزشکی را به‌روز می‌کنید.
+خلاصه فعلی و نوبت‌های جدید گفتگو در پیام کاربر آمده است.
+
+خلاصه جدید را به صورت فهرست کوتاه و فشرده بنویسید و فقط موارد بالینی را نگه دارید:
+علائم و تغییرات آن‌ها، پاسخ‌های بیمار به سوالات، سوابق و داروها، علائم خطر،
+و جمع‌بندی فعلی پزشک. هیچ اطلاعات بالینی از خلاصه فعلی را حذف نکنید.
+""", """## خلاصه فعلی:
+{summary}
+
+## نوبت‌های جدید گفتگو:
+{turns}""")
+
+TRIAGE_JSON_PROMPT = PromptTemplate("triage", """
+شما یک سیستم هوش مصنوعی پزشکی پیشرفته هستید که به عنوان دستیار اورژانس عمل می‌کنید.
+علائم گزارش شده بیمار در پیام کاربر آمده است.
+
+پاسخ را فقط به صورت JSON مطابق ساختار خواسته شده و با متن فارسی برگردانید:
+- triage: سطح فوریت طبق پروتکل اورژانس؛ red (مراجعه فوری 0-1 ساعت)، yellow (پزشک در 24 ساعت)، green (پزشک خانواده)
+- diagnoses: 3 تا 5 تشخیص محتمل؛ name (فارسی و انگلیسی)، probability (درصد 0-100)، reason (یک جمله کوتاه)
+- red_flags: علائم خطری که در صورت بروز باید فوراً به اورژانس مراجعه کرد
+- follow_up_questions: 3 سوال مهم برای تشخیص دقیق‌تر
+- advice: توصیه‌های اولیه کوتاه (اقدامات خانگی، داروی بدون نسخه با دوز، موارد ممنوع، زمان پیگیری)
+- confidence: سطح اطمینان تحلیل؛ low، medium یا high
+
+این ارزیابی جایگزین معاینه پزشکی نیست؛ کوتاه و دقیق بنویسید.
+""", """علائم گزارش شده بیمار: {symptoms}""")
+
+
+# ============================================
+# PIPELINE FUNCTIONS
+# ============================================
+
+def format_prompt(template, **kwargs):
+    """Format prompt template with parameters"""
+    return template.format(**kwargs)
+
+
+@functools.lru_cache(maxsize=64)
+def prefix_fingerprint(system):
+    """Short hash identifying one revision of a static prompt prefix"""
+    return hashlib.sha256(system.encode("utf-8")).hexdigest()[:12]
+
+
+def record_usage(kind, model, usage, prefix=None):
+    """Book one call's token usage in the ledger and the metrics counters"""
+    get_usage_ledger().record(kind, model, usage, prefix)
+    counts = usage_counts(usage)
+    if counts is not None:
+        metrics = get_metrics()
+        metrics.count("tokens", counts[0], direction="in", kind=kind)
+        metrics.count("tokens", counts[1], direction="cached", kind=kind)
+        metrics.count("tokens", counts[2], direction="out", kind=kind)
+
+
+def prompt_request(prompt):
+    """(kind, messages, text, prefix) for a formatted Prompt or a plain string"""
+    if isinstance(prompt, (Prompt, ConversationPrompt)):
+        return prompt.kind, prompt.messages, prompt.text, prefix_fingerprint(prompt.system)
+    return "adhoc", [{"role": "user", "content": prompt}], prompt, None
+
+
+def ask_model(prompt, model=DEFAULT_MODEL, temperature=0.7, max_tokens=2000, use_cache=True,
+              response_format=None, raise_errors=False, priority="patient"):
+    """Send request to AI model with enhanced error handling
+
+    Errors come back as a Persian message for display unless raise_errors
+    is set, in which case the underlying exception propagates. priority is
+    the scheduler queue: "red_flag", "patient" or "follow_up".
+    """
+    response_cache = get_response_cache()
+    kind, messages, text, prefix = prompt_request(prompt)
+    key = make_cache_key(text, model, temperature, max_tokens, response_format)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return cached
+    options = {"response_format": response_format} if response_format else {}
+
+    def request():
+        with get_scheduler().slot(priority, estimate_tokens(text) + max_tokens):
+            with get_metrics().span("model_call", kind=kind):
+                response = get_model_client().chat(
+                    model,
+                    messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    **options
+                )
+        record_usage(kind, response.model, response.usage, prefix)
+        return response.choices[0].message.content
+
+    try:
+        # Identical requests already in flight share one upstream call
+        # (the key covers the response format, so JSON and text calls never merge)
+        answer = get_single_flight().do(("chat", key), request) or ""
+    except Exception as e:
+        if raise_errors:
+            raise
+        return f"{MODEL_ERROR_PREFIX}: {str(e)}"
+    # An empty answer (no content, e.g. a refusal) is returned but never cached
+    if use_cache and answer:
+        response_cache.set(key, answer)
+    return answer
+
+
+def ask_model_stream(prompt, model=DEFAULT_MODEL, temperature=0.7, max_tokens=2000, use_cache=True,
+                     response_format=None, priority="patient"):
+    """Stream the model answer chunk by chunk as it is generated"""
+    response_cache = get_response_cache()
+    kind, messages, text, prefix = prompt_request(prompt)
+    key = make_cache_key(text, model, temperature, max_tokens, response_format)
+    options = {"response_format": response_format} if response_format else {}
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    def open_stream():
+        # The slot is held until the stream is drained or closed
+        with get_scheduler().slot(priority, estimate_tokens(text) + max_tokens):
+            yield from get_model_client().chat_stream(
+                model,
+                messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                on_usage=lambda usage, answered_by: record_usage(kind, answered_by, usage, prefix),
+                **options
+            )
+
+    metrics = get_metrics()
+    started = time.perf_counter()
+    parts = []
+    try:
+        # Identical streams already in flight are replayed and then shared live
+        for content in get_single_flight().stream(("stream", key), open_stream):
+            if not parts:
+                metrics.observe("model_first_token", time.perf_counter() - started, kind=kind)
+            parts.append(content)
+            yield content
+    except Exception as e:
+        yield f"{MODEL_ERROR_PREFIX}: {str(e)}"
+        return
+    metrics.observe("model_generation", time.perf_counter() - started, kind=kind)
+    # Only completed answers are cached, never partial, empty or error output
+    if use_cache and parts:
+        response_cache.set(key, "".join(parts))
+
+
+def ask_triage(symptoms, model=DEFAULT_MODEL, use_cache=True, raise_errors=False, priority="patient",
+               on_chunk=None):
+    """Request the structured triage for a case; None if no valid answer came back
+
+    With on_chunk, the JSON answer is streamed and on_chunk receives the
+    text received so far after every chunk, so callers can show progress.
+    """
+    response_cache = get_response_cache()
+    prompt = format_prompt(TRIAGE_JSON_PROMPT, symptoms=symptoms)
+    # Cached by hand so that only answers passing validation are stored
+    key = make_cache_key(prompt.text, model, 0.2, 800, TRIAGE_RESPONSE_FORMAT)
+    answer = response_cache.get(key) if use_cache else None
+    fresh = answer is None
+    if fresh and on_chunk is not None:
+        parts = []
+        for chunk in ask_model_stream(
+            prompt,
+            model=model,
+            temperature=0.2,
+            max_tokens=800,
+            use_cache=False,
+            response_format=TRIAGE_RESPONSE_FORMAT,
+            priority=priority
+        ):
+            parts.append(chunk)
+            on_chunk("".join(parts))
+        answer = "".join(parts)
+        # The stream reports failures in-band; surface them like ask_model does
+        if raise_errors and is_model_error(answer):
+            raise RuntimeError(answer)
+    elif fresh:
+        answer = ask_model(
+            prompt,
+            model=model,
+            temperature=0.2,
+            max_tokens=800,
+            use_cache=False,
+            response_format=TRIAGE_RESPONSE_FORMAT,
+            raise_errors=raise_errors,
+            priority=priority
+        )
+    try:
+        result = parse_triage(answer)
+    except ValueError:
+        return None
+    if fresh and use_cache:
+        response_cache.set(key, answer)
+    return result
+
+
+def is_model_error(answer):
+    """Whether an answer is the error message shown when the model failed"""
+    # A stream that broke part-way ends with the message after the partial text
+    return MODEL_ERROR_PREFIX in answer
+
+
+def is_emergency(analysis):
+    """Check the analysis text for urgent triage markers"""
+    return "🔴" in analysis or "بحرانی" in analysis or "فوری" in analysis.lower()
+
+
+def check_recording(audio, samplerate):
+    """Run the quality gate on a recording before anything is uploaded
+
+    Returns the audio_quality.QualityCheck: problems to show the patient
+    if the recording is unusable, otherwise the (possibly corrected) mono
+    audio. The measurements go to the metrics and, with AUDIO_QUALITY_LOG
+    set, to a JSONL file.
+    """
+    from audio_prep import to_mono
+    from audio_quality import check
+
+    metrics = get_metrics()
+    with metrics.span("quality_check") as span:
+        result = check(to_mono(audio), samplerate)
+        span.set(**result.report._asdict(), problems=result.problems, corrections=result.corrections)
+    if result.problems:
+        outcome = "rejected"
+        for problem in result.problems:
+            metrics.count("recordings_rejected", 1, reason=problem)
+    else:
+        outcome = "corrected" if result.corrections else "ok"
+    metrics.count("recordings", 1, quality=outcome)
+
+    log_path = os.getenv("AUDIO_QUALITY_LOG")
+    if log_path:
+        entry = {
+            "ts": time.time(),
+            "samplerate": samplerate,
+            **{name: round(value, 4) for name, value in result.report._asdict().items()},
+            "quality": outcome,
+            "problems": result.problems,
+            "corrections": result.corrections,
+        }
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+    return result
+
+
+def prepare_recording(audio, samplerate, container="wav"):
+    """Resample, trim silence and encode a recording for upload
+
+    Returns the PreparedAudio and the VAD statistics (without the audio).
+    """
+    from audio_prep import TARGET_SAMPLE_RATE, prepare_audio, resample, to_mono
+    from vad import trim_silence
+
+    metrics = get_metrics()
+    with metrics.span("prepare_audio"):
+        signal = resample(to_mono(audio), samplerate)
+        vad = trim_silence(signal, TARGET_SAMPLE_RATE)
+        prepared = prepare_audio(vad.audio, TARGET_SAMPLE_RATE, container=container)
+    metrics.count("audio_seconds", vad.original_seconds, stage="recorded")
+    metrics.count("audio_seconds", prepared.seconds, stage="uploaded")
+    return prepared, vad._replace(audio=None)
+
+
+def transcribe_wav(source, container="wav"):
+    """Load a WAV file (path or file object), prepare and transcribe it
+
+    Returns the transcript together with the PreparedAudio and VAD stats.
+    """
+    from audio_prep import load_wav
+
+    audio, samplerate = load_wav(source)
+    prepared, vad = prepare_recording(audio, samplerate, container=container)
+    return transcribe_audio(prepared), prepared, vad
+
+
+def transcribe_audio(prepared, prompt=None, priority="patient"):
+    """Transcribe prepared audio with whisper-1, optionally with prior context"""
+    options = {"prompt": prompt} if prompt else {}
+
+    def request():
+        metrics = get_metrics()
+        metrics.count("upload_bytes", len(prepared.data))
+        # Upload and recognition are one HTTP request, so they share a span
+        with get_scheduler().slot(priority), metrics.span("transcription"):
+            transcript = get_model_client().transcribe(
+                TRANSCRIPTION_MODEL,
+                prepared.upload_file(),
+                language="fa",
+                **options
+            )
+        return transcript.text
+
+    key = ("transcription", hashlib.sha256(prepared.data).hexdigest(), prompt)
+    return get_single_flight().do(key, request)
+
+
+def conversation_prompt(conversation):
+    """Prompt for the next follow-up reply: case, summary and recent turns
+
+    Between folds the summary does not change, so each request extends the
+    previous one and the provider can reuse its cached prefix.
+    """
+    return ConversationPrompt(
+        FOLLOW_UP_CHAT_PROMPT.kind,
+        FOLLOW_UP_CHAT_PROMPT.system,
+        FOLLOW_UP_CHAT_PROMPT.user.format(
+            symptoms=conversation.symptoms,
+            analysis=conversation.analysis or "-",
+            summary=conversation.summary or "-"
+        ),
+        tuple(conversation.recent())
+    )
+
+
+def summarize_conversation(summary, turns, priority="follow_up"):
+    """Fold conversation turns into the rolling clinical summary"""
+    from conversation import format_turns
+
+    prompt = format_prompt(CONVERSATION_SUMMARY_PROMPT, summary=summary or "-", turns=format_turns(turns))
+    return ask_model(
+        prompt,
+        temperature=0.2,
+        max_tokens=int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "400")),
+        raise_errors=True,
+        priority=priority
+    )
+
+
+def doctor_panel_prompts(symptoms):
+    """Build the doctor-panel prompts for a case"""
+    return {
+        "questions": format_prompt(DOCTOR_QUESTIONS_PROMPT, symptoms=symptoms),
+        "emergency": format_prompt(EMERGENCY_PROTOCOL, symptoms=symptoms)
+    }
+
+
+def analyze_symptoms(symptoms, structured=True, use_cache=True, raise_errors=False):
+    """Run red-flag matching and the patient analysis for one case
+
+    Returns a plain dict with the analysis Markdown, the triage dict (when
+    structured mode produced one), matched red-flag ids and the emergency
+    verdict.
+    """
+    flags = get_red_flag_matcher().match(symptoms)
+    priority = "red_flag" if flags else "patient"
+    triage = None
+    if structured:
+        triage = ask_triage(symptoms, use_cache=use_cache, raise_errors=raise_errors, priority=priority)
+    if triage is not None:
+        analysis = triage.to_markdown()
+        urgent = triage.is_emergency
+    else:
+        prompt = format_prompt(
+            PATIENT_ANALYSIS_PROMPT,
+            symptoms=symptoms,
+            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
+        analysis = ask_model(prompt, use_cache=use_cache, raise_errors=raise_errors, priority=priority)
+        urgent = is_emergency(analysis)
+    return {
+        "symptoms": symptoms,
+        "analysis": analysis,
+        "triage": triage.to_dict() if triage else None,
+        "red_flags": [flag.id for flag in flags],
+        "emergency": bool(flags) or urgent,
+    }
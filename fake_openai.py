@@ -0,0 +1,236 @@
+"""Local stand-in for the OpenAI chat and transcription endpoints.
+
+Point OPENAI_BASE_URL at it to exercise the app without a real provider:
+
+    python fake_openai.py --port 8765 --chat-ttft lognormal:0.4,0.5 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=x streamlit run voice.py
+
+Latency distributions are given as "fixed:S", "uniform:LOW,HIGH",
+"lognormal:MEDIAN,SIGMA" or "exp:MEAN" (all in seconds). Answers stream
+over SSE when requested, structured (json_schema) requests get a valid
+triage object, and a share of requests can be failed with 500s or
+rejected with 429s, on top of an optional requests-per-minute limit.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from collections import deque
+
+from aiohttp import web
+
+# ============================================
+# LATENCY DISTRIBUTIONS
+# ============================================
+
+
+def parse_distribution(spec, rng=random):
+    """Build a sampler (returning seconds) from a distribution spec"""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: rng.lognormvariate(math.log(median), sigma)
+    if kind == "exp":
+        return lambda: rng.expovariate(1 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+SYMPTOMS = [
+    "از دیروز سردرد شدید دارم و به نور حساس شده‌ام",
+    "سه روز است سرفه خشک و تب خفیف دارم",
+    "بعد از غذا درد شکم و حالت تهوع دارم",
+    "از صبح گلو درد دارم و بلعیدن سخت است",
+    "چند روز است کمردرد دارم که با نشستن بدتر می‌شود",
+    "از دیشب اسهال و ضعف دارم",
+]
+
+ANSWER_WORDS = (
+    "بر اساس علائم گزارش شده وضعیت بیمار نیاز به بررسی بیشتر دارد و "
+    "توصیه می‌شود در صورت تشدید علائم به پزشک مراجعه شود"
+).split()
+
+
+def estimate_tokens(text):
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+# ============================================
+# FAKE SERVER
+# ============================================
+
+
+class FakeOpenAI:
+    """Request handlers plus the counters exposed on /stats"""
+
+    def __init__(self, options, rng=None):
+        self.options = options
+        self.rng = rng or random.Random(options.seed)
+        self.chat_ttft = parse_distribution(options.chat_ttft, self.rng)
+        self.transcription_latency = parse_distribution(options.transcription_latency, self.rng)
+        self.recent = deque()
+        self.seen_prefixes = set()
+        self.stats = {"requests": 0, "chat": 0, "streams": 0, "transcriptions": 0,
+                      "errors": 0, "rate_limited": 0, "started": time.time()}
+
+    def _fault(self):
+        """A 429 or 500 response for this request, or None to serve it"""
+        now = time.monotonic()
+        self.stats["requests"] += 1
+        limited = False
+        if self.options.rpm_limit:
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+            limited = len(self.recent) >= self.options.rpm_limit
+        if not limited:
+            self.recent.append(now)
+        if limited or self.rng.random() < self.options.rate_limit_rate:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": str(self.options.retry_after)}
+            )
+        if self.rng.random() < self.options.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response({"error": {"message": "Injected server error"}}, status=500)
+        return None
+
+    def _usage(self, messages, completion_tokens):
+        prompt_tokens = sum(estimate_tokens(m.get("content") or "") for m in messages)
+        cached = 0
+        system = next((m["content"] for m in messages if m.get("role") == "system"), None)
+        if system is not None:
+            # Mimic provider prefix caching: 128-token blocks of a >=1024-token prefix seen before
+            prefix = hashlib.sha256(system.encode("utf-8")).digest()
+            prefix_tokens = estimate_tokens(system)
+            if prefix in self.seen_prefixes and prefix_tokens >= 1024:
+                cached = prefix_tokens // 128 * 128
+            self.seen_prefixes.add(prefix)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    def _answer(self, body):
+        if body.get("response_format", {}).get("type") == "json_schema":
+            return json.dumps({
+                "triage": self.rng.choice(["green", "green", "yellow", "red"]),
+                "diagnoses": [
+                    {"name": "سرماخوردگی (Common cold)", "probability": 60, "reason": "علائم تنفسی خفیف"},
+                    {"name": "آنفولانزا (Influenza)", "probability": 30, "reason": "تب و ضعف"},
+                ],
+                "red_flags": ["تنگی نفس شدید"],
+                "follow_up_questions": ["تب چند درجه است؟"],
+                "advice": ["استراحت و مصرف مایعات"],
+                "confidence": "medium",
+            }, ensure_ascii=False)
+        words = min(int(body.get("max_tokens") or 2000), self.options.completion_tokens)
+        return " ".join(self.rng.choice(ANSWER_WORDS) for _ in range(words))
+
+    async def chat(self, request):
+        fault = self._fault()
+        if fault is not None:
+            return fault
+        body = await request.json()
+        self.stats["chat"] += 1
+        answer = self._answer(body)
+        pieces = answer.split(" ")
+        usage = self._usage(body.get("messages", []), len(pieces))
+        created = int(time.time())
+        await asyncio.sleep(self.chat_ttft())
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.options.token_interval * len(pieces))
+            return web.json_response({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": created,
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        self.stats["streams"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(payload):
+            await response.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(self.options.token_interval)
+            await send({
+                "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created,
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": " " + piece if i else piece},
+                             "finish_reason": None}],
+            })
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await send({"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created,
+                        "model": body["model"], "choices": [], "usage": usage})
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def transcription(self, request):
+        fault = self._fault()
+        if fault is not None:
+            return fault
+        size = 0
+        reader = await request.multipart()
+        async for part in reader:
+            data = await part.read()
+            if part.name == "file":
+                size = len(data)
+        self.stats["transcriptions"] += 1
+        # 16 kHz 16-bit mono: 32000 bytes per second of audio
+        audio_seconds = size / 32000
+        await asyncio.sleep(self.transcription_latency() + audio_seconds * self.options.transcription_rtf)
+        return web.json_response({"text": f"{self.rng.choice(SYMPTOMS)} ({self.rng.randrange(10 ** 6)})"})
+
+    async def get_stats(self, request):
+        return web.json_response({**self.stats, "uptime": round(time.time() - self.stats["started"], 3)})
+
+
+def create_app(options):
+    fake = FakeOpenAI(options)
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.add_routes([
+        web.post("/v1/chat/completions", fake.chat),
+        web.post("/v1/audio/transcriptions", fake.transcription),
+        web.get("/stats", fake.get_stats),
+    ])
+    return app
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--chat-ttft", default="lognormal:0.4,0.4", help="time to first token")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="seconds between streamed tokens")
+    parser.add_argument("--completion-tokens", type=int, default=150, help="words per free-text answer")
+    parser.add_argument("--transcription-latency", default="lognormal:0.6,0.3")
+    parser.add_argument("--transcription-rtf", type=float, default=0.05,
+                        help="extra transcription seconds per second of audio")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failed with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests rejected with 429")
+    parser.add_argument("--rpm-limit", type=int, default=0, help="429 above this many requests per minute")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds on 429")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+if __name__ == "__main__":
+    options = build_parser().parse_args()
+    web.run_app(create_app(options), host=options.host, port=options.port, print=None)
@@ -0,0 +1,247 @@
+"""Per-stage latency histograms, counters and consultation traces.
+
+Spans are context managers around pipeline stages. When metrics are off
+span() returns one shared no-op object, so the instrumentation left in the
+code costs a function call per stage. When on, durations land in
+Prometheus-style histograms and, if a trace is bound to the current
+thread, in that consultation's trace, which is appended to a JSONL file
+as one line when it finishes.
+"""
+
+import bisect
+import contextlib
+import json
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; spans from a few milliseconds of rendering to minute-long generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+_current_trace = ContextVar("current_trace", default=None)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Trace:
+    """Spans and counters of one consultation"""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started = time.time()
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, start, seconds, attrs):
+        with self._lock:
+            self.spans.append({
+                "stage": stage,
+                "offset_ms": round((start - self.started) * 1000, 1),
+                "duration_ms": round(seconds * 1000, 1),
+                **attrs,
+            })
+
+    def add(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "started": round(self.started, 3),
+                "total_ms": round((time.time() - self.started) * 1000, 1),
+                "spans": list(self.spans),
+                "counters": dict(self.counters),
+            }
+
+
+class _Span:
+    __slots__ = ("metrics", "stage", "labels", "attrs", "start", "wall_start")
+
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+        self.attrs = {}
+
+    def set(self, **attrs):
+        """Attach extra attributes to the trace entry of this span"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.metrics.observe(self.stage, seconds, start=self.wall_start, attrs=self.attrs, **self.labels)
+        return False
+
+
+class Metrics:
+    """Stage histograms and counters in Prometheus text format"""
+
+    def __init__(self, enabled=False, trace_log=None, namespace="voice2doc", buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.trace_log = trace_log
+        self.namespace = namespace
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def span(self, stage, **labels):
+        """Time a block as one observation of stage"""
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, stage, labels)
+
+    def observe(self, stage, seconds, start=None, attrs=None, **labels):
+        """Record a duration measured elsewhere (e.g. time to first token)"""
+        if not self.enabled:
+            return
+        key = (stage, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+        trace = _current_trace.get()
+        if trace is not None:
+            start = time.time() - seconds if start is None else start
+            trace.add_span(stage, start, seconds, {**labels, **(attrs or {})})
+
+    def count(self, name, value=1, **labels):
+        """Add to a counter such as audio seconds, bytes uploaded or tokens"""
+        if not self.enabled or not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name if not labels else f"{name}:{','.join(map(str, labels.values()))}", value)
+
+    # Traces
+
+    def new_trace(self, trace_id=None):
+        """Start a consultation trace, or None when tracing is off"""
+        if not self.enabled or not self.trace_log:
+            return None
+        return Trace(trace_id)
+
+    def bind(self, trace):
+        """Make trace the current one for spans in this thread/context"""
+        if self.enabled:
+            _current_trace.set(trace)
+
+    @contextlib.contextmanager
+    def bound(self, trace):
+        """Bind trace for the duration of a block"""
+        token = _current_trace.set(trace) if self.enabled else None
+        try:
+            yield trace
+        finally:
+            if token is not None:
+                _current_trace.reset(token)
+
+    def finish_trace(self, trace):
+        """Append a finished trace as one JSON line"""
+        if trace is None:
+            return
+        if _current_trace.get() is trace:
+            _current_trace.set(None)
+        line = json.dumps(trace.to_dict(), ensure_ascii=False)
+        with self._lock, open(self.trace_log, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    # Export
+
+    def _labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        """Prometheus text exposition of every histogram and counter"""
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+        name = f"{self.namespace}_stage_seconds"
+        lines = [f"# HELP {name} Duration of pipeline stages", f"# TYPE {name} histogram"]
+        for (stage, labels), (counts, total, count) in sorted(histograms.items()):
+            labels = (("stage", stage),) + labels
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        seen = set()
+        for (counter, labels), value in sorted(counters.items()):
+            full = f"{self.namespace}_{counter}_total"
+            if full not in seen:
+                seen.add(full)
+                lines.append(f"# TYPE {full} counter")
+            lines.append(f"{full}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host="127.0.0.1", port=9464):
+        """Serve /metrics from a background thread (once per process)"""
+        if self._server is not None:
+            return self._server
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-exporter", daemon=True).start()
+        return self._server
@@ -0,0 +1,368 @@
+"""Resilience layer for upstream model calls.
+
+Every chat and transcription request goes through ResilientClient, which
+gives it a deadline, retries retryable failures with jittered exponential
+backoff, optionally hedges slow requests with a second copy once the
+endpoint's p95 latency has passed, trips a circuit breaker per endpoint
+and falls back to an alternate chat model when the primary one is failing.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# ============================================
+# ERRORS
+# ============================================
+
+
+class DeadlineExceeded(TimeoutError):
+    """The call's overall time budget ran out"""
+
+
+class CircuitOpenError(RuntimeError):
+    """The endpoint's circuit breaker is rejecting calls"""
+
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def is_retryable(error):
+    """Whether an upstream error is worth retrying (timeouts, 429, 5xx)"""
+    from openai import APIConnectionError
+
+    if isinstance(error, (APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in RETRYABLE_STATUS or status >= 500)
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait (Retry-After header), if any"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0, rng=random):
+    """Full-jitter exponential backoff for the given retry attempt (0-based)"""
+    return rng.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# ============================================
+# LATENCY TRACKING AND CIRCUIT BREAKER
+# ============================================
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies for one endpoint"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def quantile(self, q):
+        with self._lock:
+            values = sorted(self._samples)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures -> half-open after a cool-down
+
+    While open every call is rejected; once reset_timeout has passed a
+    single trial call is let through and its outcome closes or reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._clock() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        """Whether a call may go out now"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._clock() - self._opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._trial_running = False
+
+
+# ============================================
+# RESILIENT CLIENT
+# ============================================
+
+
+class ResilientClient:
+    """Deadlines, retries, hedging, circuit breaking and model fallback
+
+    client_factory returns an OpenAI client; it should be created with
+    max_retries=0 so that retries are not stacked on top of the SDK's own.
+    """
+
+    def __init__(self, client_factory, deadline=60.0, transcription_deadline=120.0,
+                 attempt_timeout=None, max_retries=3, backoff_base=0.5, backoff_cap=8.0,
+                 hedge=False, hedge_quantile=0.95, hedge_min_samples=20, hedge_min_delay=0.5,
+                 fallback_model=None, failure_threshold=5, reset_timeout=30.0,
+                 hedge_workers=8, rng=None):
+        self._client_factory = client_factory
+        self.deadline = deadline
+        self.transcription_deadline = transcription_deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.fallback_model = fallback_model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._rng = rng or random.Random()
+        self._breakers = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._hedge_executor = None
+        if hedge:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge")
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0, "rejected": 0}
+
+    @property
+    def client(self):
+        return self._client_factory()
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[endpoint]
+
+    def latencies(self, endpoint):
+        with self._lock:
+            if endpoint not in self._latencies:
+                self._latencies[endpoint] = LatencyTracker()
+            return self._latencies[endpoint]
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _attempt_timeout(self, deadline_at):
+        remaining = max(0.0, deadline_at - time.monotonic())
+        return min(remaining, self.attempt_timeout) if self.attempt_timeout else remaining
+
+    def hedge_delay(self, endpoint):
+        """Delay before a hedge is sent, or None while there is too little history"""
+        tracker = self.latencies(endpoint)
+        if len(tracker) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, tracker.quantile(self.hedge_quantile))
+
+    def call(self, endpoint, request, deadline=None, hedge=None):
+        """Run request(timeout) against endpoint with retries until the deadline
+
+        request receives the timeout for the attempt (the time left, capped
+        by attempt_timeout) and must raise on failure. Non-retryable errors
+        propagate at once.
+        """
+        deadline_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+        breaker = self.breaker(endpoint)
+        hedge = self.hedge if hedge is None else hedge
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"{endpoint}: deadline exceeded after {attempt} attempts")
+            if not breaker.allow():
+                self._count("rejected")
+                raise CircuitOpenError(f"{endpoint}: circuit open")
+            started = time.monotonic()
+            try:
+                if hedge and self._hedge_executor is not None:
+                    result = self._hedged(endpoint, request, deadline_at)
+                else:
+                    result = request(self._attempt_timeout(deadline_at))
+            except Exception as e:
+                if not is_retryable(e):
+                    breaker.record_success()  # the endpoint answered; the request was bad
+                    raise
+                breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after(e) or backoff_delay(attempt, self.backoff_base, self.backoff_cap, self._rng)
+                if time.monotonic() + delay >= deadline_at:
+                    raise
+                self._count("retries")
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            self.latencies(endpoint).add(time.monotonic() - started)
+            return result
+
+    def _hedged(self, endpoint, request, deadline_at):
+        """Send a second copy of the request if the first outlives the hedge delay"""
+        delay = self.hedge_delay(endpoint)
+        first = self._hedge_executor.submit(request, self._attempt_timeout(deadline_at))
+        if delay is None:
+            return first.result()
+        done, _ = wait([first], timeout=min(delay, max(0.0, deadline_at - time.monotonic())))
+        if done:
+            return first.result()
+        self._count("hedges")
+        second = self._hedge_executor.submit(request, self._attempt_timeout(deadline_at))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline_at - time.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded(f"{endpoint}: hedged request timed out")
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count("hedge_wins")
+                    # The slower copy cannot be aborted mid-request; its result is dropped
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _models(self, model):
+        models = [model]
+        if self.fallback_model and self.fallback_model != model:
+            models.append(self.fallback_model)
+        return models
+
+    def _with_fallback(self, model, attempt, deadline_at):
+        """Run attempt(model) for the primary model, then the fallback on failure
+
+        The fallback shares the call's deadline; once it has passed, no
+        further candidate is tried.
+        """
+        models = self._models(model)
+        for i, candidate in enumerate(models):
+            try:
+                return attempt(candidate)
+            except Exception as e:
+                last = i == len(models) - 1
+                if last or not (isinstance(e, (CircuitOpenError, DeadlineExceeded)) or is_retryable(e)):
+                    raise
+                if time.monotonic() >= deadline_at:
+                    raise DeadlineExceeded(f"chat:{model}: deadline exceeded before fallback") from e
+                self._count("fallbacks")
+
+    def chat(self, model, messages, deadline=None, hedge=None, **options):
+        """chat.completions.create with the full resilience policy"""
+        deadline_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+
+        def attempt(candidate):
+            return self.call(
+                f"chat:{candidate}",
+                lambda timeout: self.client.chat.completions.create(
+                    model=candidate, messages=messages, timeout=timeout, **options
+                ),
+                deadline=max(0.0, deadline_at - time.monotonic()),
+                hedge=hedge
+            )
+
+        return self._with_fallback(model, attempt, deadline_at)
+
+    def chat_stream(self, model, messages, deadline=None, on_usage=None, **options):
+        """Yield content chunks of a streamed chat completion
+
+        Retries and fallback apply only until the first chunk has arrived;
+        a stream that breaks after that raises, since the caller already
+        has part of the answer. Streams are never hedged. on_usage, if
+        given, receives the final usage report and the model that answered.
+        """
+        deadline_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+        if on_usage is not None:
+            options["stream_options"] = {"include_usage": True}
+
+        def content(chunk):
+            if getattr(chunk, "usage", None) is not None and on_usage is not None:
+                on_usage(chunk.usage, chunk.model)
+            if chunk.choices and chunk.choices[0].delta.content:
+                return chunk.choices[0].delta.content
+            return None
+
+        def open_stream(candidate):
+            def request(timeout):
+                stream = self.client.chat.completions.create(
+                    model=candidate, messages=messages, stream=True, timeout=timeout, **options
+                )
+                chunks = iter(stream)
+                # Pull until the first content so connection errors are retried here
+                for chunk in chunks:
+                    text = content(chunk)
+                    if text:
+                        return text, chunks
+                return None, chunks
+
+            return self.call(
+                f"chat:{candidate}", request,
+                deadline=max(0.0, deadline_at - time.monotonic()), hedge=False
+            )
+
+        first, chunks = self._with_fallback(model, open_stream, deadline_at)
+        if first is not None:
+            yield first
+        for chunk in chunks:
+            text = content(chunk)
+            if text:
+                yield text
+
+    def transcribe(self, model, file, deadline=None, hedge=None, **options):
+        """audio.transcriptions.create with deadline, retries and breaker"""
+        return self.call(
+            f"transcription:{model}",
+            lambda timeout: self.client.audio.transcriptions.create(
+                model=model, file=file, timeout=timeout, **options
+            ),
+            deadline=self.transcription_deadline if deadline is None else deadline,
+            hedge=hedge
+        )
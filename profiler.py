@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+from collections import deque
+
+# ============================================
+# RERUN PROFILER
+# ============================================
+
+
+class RerunProfiler:
+    """Per-section timings of script reruns, shared by every session
+
+    A rerun is timed with laps: each call to lap(section) charges the time
+    since the previous lap to that section, so the script needs one call
+    after each part instead of being wrapped in blocks.
+    """
+
+    def __init__(self, enabled=False, window=500, log_path=None):
+        self.enabled = enabled
+        self.window = window
+        self.log_path = log_path
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def rerun(self):
+        """Start timing one rerun; a no-op timer when profiling is off"""
+        return RerunTimer(self) if self.enabled else NULL_TIMER
+
+    def record(self, section, seconds):
+        with self._lock:
+            samples = self._samples.get(section)
+            if samples is None:
+                samples = self._samples[section] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def stats(self):
+        """Count, mean, p50, p95 and max in milliseconds for every section"""
+        with self._lock:
+            snapshot = {section: sorted(samples) for section, samples in self._samples.items()}
+        stats = {}
+        for section, values in snapshot.items():
+            n = len(values)
+            stats[section] = {
+                "count": n,
+                "mean_ms": round(sum(values) / n * 1000, 2),
+                "p50_ms": round(values[(n - 1) // 2] * 1000, 2),
+                "p95_ms": round(values[min(n - 1, int(n * 0.95))] * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+        return stats
+
+    def _log(self, laps):
+        with self._lock, open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(laps) + "\n")
+
+
+class RerunTimer:
+    """Lap timer for a single rerun"""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.started = self._last = time.perf_counter()
+        self.laps = {}
+
+    def lap(self, section):
+        """Charge the time since the previous lap to section"""
+        now = time.perf_counter()
+        self.laps[section] = self.laps.get(section, 0.0) + now - self._last
+        self.profiler.record(section, now - self._last)
+        self._last = now
+
+    def finish(self):
+        """Record the whole rerun and append it to the log file if one is set"""
+        total = time.perf_counter() - self.started
+        self.profiler.record("total", total)
+        if self.profiler.log_path:
+            self.profiler._log({
+                "time": time.time(),
+                **{section: round(seconds * 1000, 3) for section, seconds in self.laps.items()},
+                "total": round(total * 1000, 3),
+            })
+
+
+class _NullTimer:
+    def lap(self, section):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TIMER = _NullTimer()
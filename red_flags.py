@@ -0,0 +1,134 @@
+import json
+import os
+import re
+import sys
+import time
+from collections import deque, namedtuple
+
+# ============================================
+# RED-FLAG MATCHER
+# ============================================
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "red_flags.json")
+DEFAULT_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "red_flag_corpus.jsonl")
+
+RedFlag = namedtuple("RedFlag", "id label category")
+
+# Arabic letter variants, Persian/Arabic-Indic digits and ZWNJ folded to one form
+CHAR_MAP = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی",
+    "ك": "ک",
+    "ة": "ه", "ۀ": "ه",
+    "أ": "ا", "إ": "ا", "ٱ": "ا",
+    "ؤ": "و",
+    "\u200c": " ", "\u200d": "", "\u0640": "",
+    **{chr(0x06F0 + d): str(d) for d in range(10)},
+    **{chr(0x0660 + d): str(d) for d in range(10)},
+})
+DIACRITICS = re.compile("[\u064b-\u0652\u0670]")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_persian(text):
+    """Fold Persian text to a canonical form for matching"""
+    text = text.replace("ه\u200cی ", "ه ")  # ezafe: «قفسه‌ی سینه» → «قفسه سینه»
+    text = DIACRITICS.sub("", text.translate(CHAR_MAP))
+    return WHITESPACE.sub(" ", text).strip().lower()
+
+
+class RedFlagMatcher:
+    """Aho-Corasick automaton over normalized red-flag phrases
+
+    Matches must start at a word boundary but may end inside a word, so
+    Persian suffixes («فلج‌شده», «تشنجش») still match while «تب» does not
+    fire inside «مرتب».
+    """
+
+    def __init__(self, rules):
+        self.flags = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for rule in rules:
+            flag_index = len(self.flags)
+            self.flags.append(RedFlag(rule["id"], rule["label"], rule.get("category", "")))
+            for pattern in rule["patterns"]:
+                self._add(normalize_persian(pattern), flag_index)
+        self._build()
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_RULES_PATH):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _add(self, pattern, flag_index):
+        node = 0
+        for char in pattern:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((len(pattern), flag_index))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def match(self, text):
+        """Return the red flags found in text, in order of first appearance"""
+        text = normalize_persian(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        found = []
+        seen = set()
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, flag_index in out[node]:
+                start = end - length + 1
+                if flag_index not in seen and (start == 0 or not text[start - 1].isalnum()):
+                    seen.add(flag_index)
+                    found.append(self.flags[flag_index])
+        return found
+
+
+def benchmark(matcher, corpus_path=DEFAULT_CORPUS_PATH, repeat=200):
+    """Measure matching speed and accuracy against a labelled corpus"""
+    with open(corpus_path, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    true_pos = false_pos = false_neg = 0
+    for item in corpus:
+        expected = set(item["flags"])
+        got = {flag.id for flag in matcher.match(item["text"])}
+        true_pos += len(expected & got)
+        false_pos += len(got - expected)
+        false_neg += len(expected - got)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in corpus:
+            matcher.match(item["text"])
+    elapsed = time.perf_counter() - start
+    return {
+        "sentences": len(corpus),
+        "precision": true_pos / max(true_pos + false_pos, 1),
+        "recall": true_pos / max(true_pos + false_neg, 1),
+        "microseconds_per_sentence": elapsed / (repeat * len(corpus)) * 1e6,
+    }
+
+
+if __name__ == "__main__":
+    corpus = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CORPUS_PATH
+    print(json.dumps(benchmark(RedFlagMatcher.from_file(), corpus), indent=2))
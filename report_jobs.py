@@ -0,0 +1,333 @@
+import html
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import core
+from consultation_store import connect
+from speculation import case_key
+
+# ============================================
+# BACKGROUND REPORT JOBS
+# ============================================
+
+ReportJob = namedtuple(
+    "ReportJob",
+    "id case_key status progress stage created updated markdown html error"
+)
+
+# Report sections in order; parts already computed for the case are reused
+REPORT_SECTIONS = [
+    ("analysis", "📋 تحلیل اولیه"),
+    ("questions", "❓ سوالات تکمیلی پیشنهادی"),
+    ("emergency", "🚨 ارزیابی فوریت"),
+    ("summary", "🩺 جمع‌بندی و برنامه پیشنهادی"),
+]
+
+STAGE_LABELS = dict(REPORT_SECTIONS, queued="⏳ در صف", done="✅ آماده", failed="❌ ناموفق")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS report_jobs (
+    id TEXT PRIMARY KEY,
+    case_key TEXT NOT NULL,
+    session_id TEXT,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    stage TEXT,
+    priority TEXT NOT NULL,
+    symptoms TEXT NOT NULL,
+    parts_json TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    markdown TEXT,
+    html TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS report_jobs_case ON report_jobs (case_key, created);
+"""
+
+_JOB_COLUMNS = "id, case_key, status, progress, stage, created, updated, markdown, html, error"
+
+
+class ReportJobs:
+    """Comprehensive reports generated in a thread pool, tracked in SQLite
+
+    submit() returns a job id at once; the worker writes progress and the
+    finished Markdown/HTML to the job table, which any session (or another
+    process sharing the file) can poll with get(). Concurrent requests for
+    the same case share one job, and jobs left unfinished by a restart are
+    queued again on startup. A finished report is shared for max_age
+    seconds, as long as it was built from the same parts.
+    """
+
+    def __init__(self, path="reports.sqlite3", max_workers=2, executor=None, stale_seconds=600,
+                 max_age=3600):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report")
+        self._conn = connect(path)
+        self._conn.executescript(SCHEMA)
+        self.stale_seconds = stale_seconds
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.resume()
+
+    def submit(self, symptoms, parts=None, priority="follow_up", session_id=None, regenerate=False):
+        """Queue a report for a case and return its job id
+
+        parts maps section names to text already computed for the case
+        (e.g. the analysis or precomputed doctor-panel answers). A finished
+        report is replaced once it is older than max_age, when parts
+        differ from the ones it was built from, or with regenerate.
+        """
+        key = case_key(symptoms)
+        parts = {name: text for name, text in (parts or {}).items()
+                 if text and not core.is_model_error(text)}
+        now = time.time()
+        with self._lock, self._conn:
+            # A report that is queued, running or done is shared by every doctor
+            row = self._conn.execute(
+                "SELECT id, status, updated, parts_json FROM report_jobs "
+                "WHERE case_key = ? AND status != 'failed' ORDER BY created DESC LIMIT 1",
+                (key,)
+            ).fetchone()
+            if row is not None and row[1] == "done":
+                built_from = json.loads(row[3])
+                current = row[2] >= now - self.max_age and all(
+                    built_from.get(name) == text for name, text in parts.items()
+                )
+                if current and not regenerate:
+                    return row[0]
+                row = None  # outdated: build a new report
+            elif row is not None and not (row[1] == "running" and row[2] < now - self.stale_seconds):
+                return row[0]
+            if row is not None:
+                # Its worker died; pick it up again with the sections it finished
+                job_id = row[0]
+                self._conn.execute("UPDATE report_jobs SET status = 'queued' WHERE id = ?", (job_id,))
+            else:
+                job_id = uuid.uuid4().hex
+                self._conn.execute(
+                    "INSERT INTO report_jobs (id, case_key, session_id, status, stage, priority, symptoms, "
+                    "parts_json, created, updated) VALUES (?, ?, ?, 'queued', 'queued', ?, ?, ?, ?, ?)",
+                    (job_id, key, session_id, priority, symptoms,
+                     json.dumps(parts, ensure_ascii=False), now, now)
+                )
+        self.executor.submit(self._run, job_id)
+        return job_id
+
+    def get(self, job_id):
+        """Current state of a job, or None for an unknown id"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {_JOB_COLUMNS} FROM report_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return ReportJob(*row) if row else None
+
+    def resume(self):
+        """Queue again the jobs a previous process left unfinished
+
+        A running job counts as abandoned once it has made no progress for
+        stale_seconds, so a live worker in another process keeps its job.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE report_jobs SET status = 'queued' WHERE status = 'running' AND updated < ?",
+                (time.time() - self.stale_seconds,)
+            )
+            rows = self._conn.execute(
+                "SELECT id FROM report_jobs WHERE status = 'queued' ORDER BY created"
+            ).fetchall()
+        for (job_id,) in rows:
+            self.executor.submit(self._run, job_id)
+
+    def _update(self, job_id, **fields):
+        fields["updated"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE report_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id)
+            )
+
+    def _claim(self, job_id):
+        """Mark a queued job running; None if another worker already took it"""
+        with self._lock, self._conn:
+            claimed = self._conn.execute(
+                "UPDATE report_jobs SET status = 'running', updated = ? "
+                "WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id)
+            ).rowcount
+            row = self._conn.execute(
+                "SELECT symptoms, parts_json, priority FROM report_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return row if claimed else None
+
+    def _run(self, job_id):
+        claimed = self._claim(job_id)
+        if claimed is None:
+            return
+        symptoms, parts_json, priority = claimed
+        parts = json.loads(parts_json)
+        try:
+            for index, (name, _) in enumerate(REPORT_SECTIONS):
+                self._update(job_id, stage=name, progress=index / len(REPORT_SECTIONS))
+                if name not in parts:
+                    parts[name] = generate_section(name, symptoms, parts, priority)
+                    # Finished sections survive a restart of the worker
+                    self._update(job_id, parts_json=json.dumps(parts, ensure_ascii=False))
+            markdown = render_markdown(symptoms, parts)
+            self._update(job_id, status="done", stage="done", progress=1.0,
+                         markdown=markdown, html=render_html(markdown))
+        except Exception as e:
+            self._update(job_id, status="failed", stage="failed", error=str(e))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self._conn.close()
+
+
+# ============================================
+# SECTION GENERATION
+# ============================================
+
+
+def _ask(prompt, priority, max_tokens=2000):
+    # Streams join an identical speculative request still in flight, and
+    # answers completed earlier come straight from the response cache
+    answer = "".join(core.ask_model_stream(prompt, max_tokens=max_tokens, priority=priority))
+    if core.is_model_error(answer) or not answer.strip():
+        raise RuntimeError(answer or "empty model answer")
+    return answer
+
+
+def generate_section(name, symptoms, parts, priority="follow_up"):
+    """Produce one missing report section"""
+    if name == "analysis":
+        triage = core.ask_triage(symptoms, priority=priority)
+        if triage is not None:
+            return triage.to_markdown()
+        prompt = core.format_prompt(
+            core.PATIENT_ANALYSIS_PROMPT,
+            symptoms=symptoms,
+            timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
+        return _ask(prompt, priority)
+    if name == "summary":
+        # Only a short synthesis is generated here; the long sections are reused
+        prompt = core.format_prompt(
+            core.REPORT_SUMMARY_PROMPT,
+            symptoms=symptoms,
+            analysis=parts.get("analysis", ""),
+            questions=parts.get("questions", ""),
+            emergency=parts.get("emergency", "")
+        )
+        return _ask(prompt, priority, max_tokens=800)
+    return _ask(core.doctor_panel_prompts(symptoms)[name], priority)
+
+
+# ============================================
+# RENDERING
+# ============================================
+
+
+def render_markdown(symptoms, parts):
+    """Assemble the report sections into one Markdown document"""
+    lines = [
+        "# 📄 گزارش جامع مشاوره",
+        "",
+        f"**تاریخ تهیه:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        "",
+        "## 🗣️ علائم گزارش شده بیمار",
+        "",
+        symptoms.strip(),
+    ]
+    for name, title in REPORT_SECTIONS:
+        if parts.get(name):
+            lines += ["", f"## {title}", "", parts[name].strip()]
+    lines += ["", "---", "", "⚠️ این گزارش برای مشاوره اولیه است و جایگزین معاینه پزشکی نیست."]
+    return "\n".join(lines) + "\n"
+
+
+_INLINE = [
+    (re.compile(r"\*\*(.+?)\*\*"), r"<strong>\1</strong>"),
+    (re.compile(r"(?<!\*)\*(?!\s)(.+?)\*"), r"<em>\1</em>"),
+    (re.compile(r"`(.+?)`"), r"<code>\1</code>"),
+]
+
+
+def _inline(text):
+    text = html.escape(text)
+    for pattern, replacement in _INLINE:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def markdown_to_html(markdown):
+    """Convert the Markdown subset used in reports (headings, lists, emphasis)"""
+    out, paragraph, list_tag = [], [], None
+
+    def close_blocks():
+        nonlocal list_tag
+        if paragraph:
+            out.append(f"<p>{'<br>'.join(paragraph)}</p>")
+            paragraph.clear()
+        if list_tag:
+            out.append(f"</{list_tag}>")
+            list_tag = None
+
+    for line in markdown.splitlines():
+        stripped = line.strip()
+        heading = re.match(r"(#{1,6})\s+(.*)", stripped)
+        item = re.match(r"(?:[-*•]|(\d+)[.)])\s+(.*)", stripped)
+        if not stripped:
+            close_blocks()
+        elif heading:
+            close_blocks()
+            level = len(heading.group(1))
+            out.append(f"<h{level}>{_inline(heading.group(2))}</h{level}>")
+        elif re.fullmatch(r"-{3,}|\*{3,}", stripped):
+            close_blocks()
+            out.append("<hr>")
+        elif item:
+            tag = "ol" if item.group(1) else "ul"
+            if list_tag != tag:
+                close_blocks()
+                out.append(f"<{tag}>")
+                list_tag = tag
+            out.append(f"<li>{_inline(item.group(2))}</li>")
+        else:
+            if list_tag:
+                close_blocks()
+            paragraph.append(_inline(stripped))
+    close_blocks()
+    return "\n".join(out)
+
+
+def render_html(markdown, title="گزارش جامع مشاوره"):
+    """Standalone right-to-left HTML page for a Markdown report"""
+    # Always the escaping converter: symptoms and model output are untrusted,
+    # and the markdown package passes raw HTML through
+    body = markdown_to_html(markdown)
+    return f"""<!DOCTYPE html>
+<html lang="fa" dir="rtl">
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>
+body {{ font-family: Tahoma, sans-serif; max-width: 820px; margin: 2em auto; line-height: 1.8; padding: 0 1em; }}
+h1, h2 {{ color: #1f4e79; }}
+hr {{ border: none; border-top: 1px solid #ccc; }}
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
@@ -0,0 +1,169 @@
+import contextlib
+import itertools
+import threading
+import time
+from collections import deque
+
+# ============================================
+# REQUEST SCHEDULER
+# ============================================
+
+# Lower runs first: red-flag cases, then patient analyses, then doctor follow-ups
+PRIORITIES = {"red_flag": 0, "patient": 1, "follow_up": 2}
+
+
+class QueueTimeout(TimeoutError):
+    """A request was not dispatched within its queue timeout"""
+
+
+def estimate_tokens(text):
+    """Rough token count for rate limiting (about one token per 4 UTF-8 bytes)"""
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+class TokenBucket:
+    """Refills per_minute units per minute up to burst; unlimited if per_minute is 0"""
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst or max(1.0, per_minute / 6))
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount, now):
+        """Seconds until amount units are available (0 if they are now)"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        # A request larger than the bucket only waits for a full bucket
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount, now):
+        if self.rate:
+            self._refill(now)
+            self.level -= amount
+
+
+class _Ticket:
+    __slots__ = ("priority", "tokens", "seq", "enqueued")
+
+    def __init__(self, priority, tokens, seq):
+        self.priority = priority
+        self.tokens = tokens
+        self.seq = seq
+        self.enqueued = time.monotonic()
+
+
+class RequestScheduler:
+    """Process-wide gate for upstream calls
+
+    Callers block in slot() until they are at the head of the priority
+    queue, a concurrency slot is free and both the requests-per-minute and
+    tokens-per-minute buckets can cover them. Waiting raises a ticket by
+    one priority level every aging_seconds so low-priority work is never
+    starved by a steady stream of urgent requests.
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=8, aging_seconds=10.0, window=500):
+        self.max_concurrency = max_concurrency
+        self.aging_seconds = aging_seconds
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queue = []
+        self._active = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._waits = {name: deque(maxlen=window) for name in PRIORITIES}
+        self._dispatched = dict.fromkeys(PRIORITIES, 0)
+        self._throttled = 0
+
+    def _rank(self, ticket, now):
+        return (PRIORITIES[ticket.priority] - (now - ticket.enqueued) / self.aging_seconds, ticket.seq)
+
+    @contextlib.contextmanager
+    def slot(self, priority="patient", tokens=0, timeout=None):
+        """Hold a dispatch slot for the duration of the block"""
+        self.acquire(priority, tokens, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, priority="patient", tokens=0, timeout=None):
+        """Block until this request may go out; raise QueueTimeout after timeout"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        with self._cond:
+            ticket = _Ticket(priority, tokens, next(self._seq))
+            self._queue.append(ticket)
+            give_up_at = ticket.enqueued + timeout if timeout is not None else None
+            was_head = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    head = min(self._queue, key=lambda t: self._rank(t, now))
+                    wait = None
+                    if head is ticket:
+                        was_head = True
+                        if self._active < self.max_concurrency:
+                            wait = max(self._requests.delay(1, now), self._tokens.delay(tokens, now))
+                            if wait == 0:
+                                break
+                            self._throttled += 1
+                    elif was_head:
+                        # Aging moved another ticket ahead while this one slept
+                        was_head = False
+                        self._cond.notify_all()
+                    if give_up_at is not None:
+                        left = give_up_at - now
+                        if left <= 0:
+                            raise QueueTimeout(f"{priority} request waited {timeout}s in the queue")
+                        wait = left if wait is None else min(wait, left)
+                    self._cond.wait(wait)
+            except BaseException:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+                raise
+            self._queue.remove(ticket)
+            self._requests.take(1, now)
+            self._tokens.take(tokens, now)
+            self._active += 1
+            self._dispatched[priority] += 1
+            self._waits[priority].append(now - ticket.enqueued)
+            # The next ticket may be able to go right away
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """Queue depth, active calls and wait times (ms) per priority"""
+        with self._cond:
+            depth = dict.fromkeys(PRIORITIES, 0)
+            for ticket in self._queue:
+                depth[ticket.priority] += 1
+            waits = {name: sorted(samples) for name, samples in self._waits.items()}
+            stats = {
+                "active": self._active,
+                "queue_depth": len(self._queue),
+                "throttled": self._throttled,
+                "priorities": {},
+            }
+            dispatched = dict(self._dispatched)
+        for name, values in waits.items():
+            n = len(values)
+            stats["priorities"][name] = {
+                "queued": depth[name],
+                "dispatched": dispatched[name],
+                "wait_p50_ms": round(values[(n - 1) // 2] * 1000, 1) if n else None,
+                "wait_p95_ms": round(values[min(n - 1, int(n * 0.95))] * 1000, 1) if n else None,
+                "wait_max_ms": round(values[-1] * 1000, 1) if n else None,
+            }
+        return stats
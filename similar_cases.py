@@ -0,0 +1,303 @@
+"""Similar-case retrieval over stored consultations, computed locally.
+
+Symptom texts are embedded as hashed character n-gram counts of the
+normalized Persian text (no model call, no vocabulary to maintain) and
+held in one contiguous float32 matrix, memory-mapped from disk. Queries
+are weighted by IDF and scored against every row with one matrix
+product, so a batch of queries costs a single pass over the matrix.
+
+    python similar_cases.py consultations.sqlite3 similar_cases/ --query "سردرد و تهوع از دیروز"
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from red_flags import normalize_persian
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking on Windows
+    fcntl = None
+
+# ============================================
+# EMBEDDING
+# ============================================
+
+DEFAULT_DIM = 2048
+NGRAM_SIZES = (2, 3, 4)
+
+SimilarCase = namedtuple("SimilarCase", "consultation_id score")
+
+PUNCTUATION = re.compile(r"[^\w\s]+")
+
+
+# Negating words; «نمی‌کنم» splits into «نمی» and «کنم» once normalized
+NEGATIONS = frozenset("""
+نه نخیر بدون هیچ نمی نیست نیستم نیستند ندارم ندارد نداره نداریم نداشتم نداشته نداشت
+نکرده نکردم نکرد نشده نشدم نشد نبوده نبودم نبود
+""".split())
+
+
+def negations(text):
+    """Negating words of a text with their neighbours, e.g. («تب», «ندارم», «و»)
+
+    N-gram similarity barely moves when a single word is negated («تب
+    دارم» against «تب ندارم»), so texts are only interchangeable if these
+    sets are equal.
+    """
+    words = PUNCTUATION.sub(" ", normalize_persian(text)).split()
+    padded = [""] + words + [""]
+    return {
+        (padded[i - 1], word, padded[i + 1])
+        for i, word in enumerate(padded)
+        if word in NEGATIONS
+    }
+
+
+def embed(text, dim=DEFAULT_DIM, sizes=NGRAM_SIZES):
+    """Sublinear term frequencies of hashed character n-grams"""
+    # Padding lets n-grams at word edges mark the start or end of a word
+    text = f" {' '.join(PUNCTUATION.sub(' ', normalize_persian(text)).split())} "
+    # crc32 rather than hash(): bucket ids must be stable across processes
+    buckets = [
+        zlib.crc32(text[i:i + n].encode("utf-8")) % dim
+        for n in sizes
+        for i in range(len(text) - n + 1)
+    ]
+    counts = np.bincount(np.asarray(buckets, dtype=np.int64), minlength=dim).astype(np.float32)
+    return np.log1p(counts, out=counts)
+
+
+# ============================================
+# INDEX
+# ============================================
+
+
+class SimilarCaseIndex:
+    """Append-only TF-IDF index stored as memory-mapped arrays in a directory
+
+    Files: vectors.f32 (capacity x dim term frequencies), ids.i64
+    (consultation id of each row), df.npy (document frequency per bucket)
+    and meta.json (row count, dimension, last indexed id). Rows are written
+    before meta.json is replaced, so a reader never sees a partial row.
+    Writers in different processes take an flock on index.lock and reload
+    meta.json under it before appending; readers reload when it changes.
+    """
+
+    def __init__(self, directory, dim=DEFAULT_DIM):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dim = dim
+        self.count = 0
+        self.capacity = 0
+        self.last_id = 0
+        self.df = np.zeros(dim, dtype=np.float64)
+        self._vectors = None
+        self._ids = None
+        self._norms = None
+        self._meta_mtime = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self, force=True):
+        path = self._path("meta.json")
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if not force and (meta["count"], meta["capacity"], meta["last_id"]) == \
+                (self.count, self.capacity, self.last_id):
+            return
+        if meta["dim"] != self.dim:
+            raise ValueError(f"Index at {self.directory} has dim {meta['dim']}, not {self.dim}")
+        self.count, self.capacity, self.last_id = meta["count"], meta["capacity"], meta["last_id"]
+        self.df = np.load(self._path("df.npy"))
+        self._map()
+        self._norms = None
+        self._meta_mtime = os.path.getmtime(path)
+
+    def _map(self):
+        if not self.capacity:
+            self._vectors = self._ids = None
+            return
+        self._vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r+",
+                                  shape=(self.capacity, self.dim))
+        self._ids = np.memmap(self._path("ids.i64"), dtype=np.int64, mode="r+", shape=(self.capacity,))
+
+    def _grow(self, needed):
+        capacity = max(1024, self.capacity * 2, needed)
+        self._vectors = self._ids = None  # release the old maps before resizing
+        for name, row_bytes in (("vectors.f32", self.dim * 4), ("ids.i64", 8)):
+            with open(self._path(name), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self._map()
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Hold the thread lock and, where available, the cross-process file lock"""
+        with self._lock, open(self._path("index.lock"), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have appended since this one last looked
+            self._load(force=False)
+            yield
+
+    def refresh(self):
+        """Pick up rows appended by another process"""
+        path = self._path("meta.json")
+        if os.path.exists(path) and os.path.getmtime(path) != self._meta_mtime:
+            with self._lock:
+                self._load()
+
+    # Writing
+
+    def add(self, items):
+        """Append (consultation_id, symptoms) pairs with ids above last_id"""
+        items = [(int(i), text) for i, text in items if int(i) > self.last_id]
+        if not items:
+            return 0
+        vectors = np.stack([embed(text, self.dim) for _, text in items])
+        with self._writing():
+            # Drop rows another process indexed while these were embedded
+            keep = [n for n, (i, _) in enumerate(items) if i > self.last_id]
+            if not keep:
+                return 0
+            items, vectors = [items[n] for n in keep], vectors[keep]
+            start = self.count
+            if start + len(items) > self.capacity:
+                self._grow(start + len(items))
+            self._vectors[start:start + len(items)] = vectors
+            self._ids[start:start + len(items)] = [i for i, _ in items]
+            self._vectors.flush()
+            self._ids.flush()
+            self.df += (vectors > 0).sum(axis=0)
+            np.save(self._path("df.npy"), self.df)
+            self.count += len(items)
+            self.last_id = items[-1][0]
+            self._norms = None
+            self._write_meta()
+        return len(items)
+
+    def _write_meta(self):
+        path = self._path("meta.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "count": self.count, "capacity": self.capacity,
+                       "last_id": self.last_id}, f)
+        os.replace(path + ".tmp", path)
+        self._meta_mtime = os.path.getmtime(path)
+
+    def sync(self, store, batch_size=1000):
+        """Index consultations added to the store since the last sync"""
+        added = 0
+        self.refresh()
+        while True:
+            rows = store.symptoms_after(self.last_id, batch_size)
+            if not rows:
+                return added
+            added += self.add(rows)
+
+    def clear(self):
+        """Forget every indexed row; store ids keep rising, so none is indexed again"""
+        with self._writing():
+            self.count = 0
+            self.df[:] = 0
+            self._norms = None
+            np.save(self._path("df.npy"), self.df)
+            self._write_meta()
+
+    # Searching
+
+    def _idf(self):
+        return (np.log((1 + self.count) / (1 + self.df)) + 1).astype(np.float32)
+
+    def _doc_norms(self, idf):
+        # Rows are stored unweighted, so their TF-IDF norms follow the
+        # current document frequencies; recomputed (in chunks) after appends
+        if self._norms is None:
+            weights = idf * idf
+            norms = np.empty(self.count, dtype=np.float32)
+            for start in range(0, self.count, 4096):
+                chunk = self._vectors[start:min(start + 4096, self.count)]
+                norms[start:start + len(chunk)] = np.sqrt((chunk * chunk) @ weights)
+            norms[norms == 0] = 1.0
+            self._norms = norms
+        return self._norms
+
+    def search_many(self, texts, k=5, min_score=0.0):
+        """Top-k (consultation_id, cosine) per query text, best first"""
+        self.refresh()
+        with self._lock:
+            if not self.count or not texts:
+                return [[] for _ in texts]
+            idf = self._idf()
+            queries = np.stack([embed(text, self.dim) for text in texts]) * idf
+            queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+            matrix = self._vectors[:self.count]
+            # (rows x dim) @ (dim x queries): every query in one pass over the matrix
+            scores = (matrix @ (queries * idf).T) / self._doc_norms(idf)[:, None]
+            ids = np.asarray(self._ids[:self.count])
+        k = min(k, len(ids))
+        results = []
+        for column in scores.T:
+            top = np.argpartition(-column, k - 1)[:k]
+            top = top[np.argsort(-column[top])]
+            results.append([SimilarCase(int(ids[i]), float(column[i])) for i in top if column[i] >= min_score])
+        return results
+
+    def search(self, text, k=5, min_score=0.0):
+        return self.search_many([text], k, min_score)[0]
+
+
+# ============================================
+# COMMAND LINE
+# ============================================
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the similar-case index")
+    parser.add_argument("store", help="consultation store (SQLite file)")
+    parser.add_argument("index", help="index directory")
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    parser.add_argument("--query", action="append", default=[], help="symptom text to look up (repeatable)")
+    parser.add_argument("-k", type=int, default=5)
+    options = parser.parse_args(argv)
+
+    from consultation_store import ConsultationStore
+
+    store = ConsultationStore(options.store)
+    index = SimilarCaseIndex(options.index, dim=options.dim)
+    started = time.perf_counter()
+    added = index.sync(store)
+    print(f"indexed {added} new consultations ({index.count} total) in "
+          f"{time.perf_counter() - started:.2f}s", file=sys.stderr)
+    if options.query:
+        started = time.perf_counter()
+        results = index.search_many(options.query, options.k)
+        print(f"{len(options.query)} queries in {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+        for query, matches in zip(options.query, results):
+            summaries = store.get_summaries(match.consultation_id for match in matches)
+            print(query)
+            for match in matches:
+                summary = summaries.get(match.consultation_id)
+                if summary is not None:
+                    print(f"  {match.score:.3f}  #{summary.id}  {summary.symptoms[:80]}")
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import threading
+
+# ============================================
+# SINGLE-FLIGHT DEDUPLICATION
+# ============================================
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "abandoned")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+
+
+class _SharedStream:
+    __slots__ = ("chunks", "buffer", "finished", "error", "consumers", "pull_lock")
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = []
+        self.finished = False
+        self.error = None
+        self.consumers = 0
+        self.pull_lock = threading.Lock()
+
+
+class SingleFlight:
+    """Merge concurrent identical requests into one upstream call
+
+    The first caller for a key runs the call; callers arriving while it is
+    in flight wait for it and receive the same result or exception. Keys
+    are forgotten as soon as the call finishes, so this never serves stale
+    answers (that is the response cache's job).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, func, timeout=None):
+        """Run func() once for all concurrent callers with the same key
+
+        A waiter that times out raises TimeoutError without affecting the
+        call. If the running caller is interrupted (for example by a
+        Streamlit rerun), a waiting caller takes over and runs it again.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self.leaders += 1
+                else:
+                    self.shared += 1
+            if leader:
+                return self._lead(key, call, func)
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight request {key!r}")
+            if call.abandoned:
+                with self._lock:
+                    self.shared -= 1
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def _lead(self, key, call, func):
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            call.abandoned = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stream(self, key, open_stream):
+        """Share one upstream stream between concurrent consumers of a key
+
+        open_stream() is called once to create the upstream iterator.
+        Consumers that join late first replay the chunks already received.
+        The upstream is closed once every consumer has stopped reading.
+        """
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is None:
+                shared = self._streams[key] = _SharedStream(open_stream())
+                self.leaders += 1
+            else:
+                self.shared += 1
+            shared.consumers += 1
+        return self._consume(key, shared)
+
+    def _finish(self, key, shared):
+        shared.finished = True
+        with self._lock:
+            if self._streams.get(key) is shared:
+                del self._streams[key]
+
+    def _consume(self, key, shared):
+        index = 0
+        try:
+            while True:
+                if index < len(shared.buffer):
+                    index += 1
+                    yield shared.buffer[index - 1]
+                    continue
+                # Whoever needs the next chunk pulls it for everyone
+                with shared.pull_lock:
+                    if index < len(shared.buffer):
+                        continue
+                    if shared.finished:
+                        break
+                    try:
+                        shared.buffer.append(next(shared.chunks))
+                    except StopIteration:
+                        self._finish(key, shared)
+                    except Exception as e:
+                        shared.error = e
+                        self._finish(key, shared)
+            if shared.error is not None:
+                raise shared.error
+        finally:
+            with self._lock:
+                shared.consumers -= 1
+                # Unpublish in the same step so nobody joins a stream being closed
+                abandoned = shared.consumers == 0 and not shared.finished
+                if abandoned and self._streams.get(key) is shared:
+                    del self._streams[key]
+            if abandoned:
+                with shared.pull_lock:
+                    shared.finished = True
+                    close = getattr(shared.chunks, "close", None)
+                    if close is not None:
+                        close()
+
+    def stats(self):
+        """Upstream calls made and calls saved by sharing"""
+        with self._lock:
+            return {
+                "upstream_calls": self.leaders,
+                "calls_saved": self.shared,
+                "in_flight": len(self._calls) + len(self._streams),
+            }
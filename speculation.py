@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# ============================================
+# SPECULATIVE PRECOMPUTATION
+# ============================================
+
+
+def case_key(symptoms):
+    """Identify a case by its symptom text"""
+    return hashlib.sha256(symptoms.strip().encode("utf-8")).hexdigest()
+
+
+def make_executor(max_workers=4):
+    """Create the shared thread pool used for speculative jobs"""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculate")
+
+
+def consume_stream(chunks, cancelled):
+    """Drain a streamed answer, stopping early once the job is cancelled"""
+    parts = []
+    try:
+        for chunk in chunks:
+            if cancelled.is_set():
+                return None
+            parts.append(chunk)
+    finally:
+        # Closing the generator also closes the upstream HTTP stream
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+    return "".join(parts)
+
+
+class SpeculativeJobs:
+    """Background jobs precomputed for the current case of one session"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.case_key = None
+        self._futures = {}
+        self._cancelled = threading.Event()
+
+    def start(self, key, jobs):
+        """Start jobs for a case, superseding jobs for any previous case
+
+        jobs maps a job name to a callable taking the cancellation event.
+        """
+        if key == self.case_key and self._futures:
+            return
+        self.cancel()
+        self.case_key = key
+        self._cancelled = threading.Event()
+        self._futures = {
+            name: self.executor.submit(job, self._cancelled)
+            for name, job in jobs.items()
+        }
+
+    def future(self, key, name):
+        """Return the future for a job of this case, or None"""
+        if key != self.case_key:
+            return None
+        return self._futures.get(name)
+
+    def cancel(self):
+        """Cancel queued jobs and signal running ones to stop"""
+        self._cancelled.set()
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self.case_key = None
@@ -0,0 +1,71 @@
+import json
+import threading
+import time
+from collections import deque
+
+# ============================================
+# TOKEN USAGE ACCOUNTING
+# ============================================
+
+
+def usage_counts(usage):
+    """(prompt, cached, completion) token counts from an OpenAI usage object"""
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    return usage.prompt_tokens or 0, cached, usage.completion_tokens or 0
+
+
+class UsageLedger:
+    """Token usage per upstream call, aggregated per prompt kind
+
+    Every call is kept in a rolling window and optionally appended to a
+    JSONL log; totals per kind show how much of the input the provider's
+    prefix cache served, and the prefix fingerprint ties a change in
+    prompt tokens to the prompt revision that caused it.
+    """
+
+    def __init__(self, log_path=None, window=1000):
+        self.log_path = log_path
+        self.calls = deque(maxlen=window)
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, model, usage, prefix=None):
+        counts = usage_counts(usage)
+        if counts is None:
+            return
+        prompt_tokens, cached_tokens, completion_tokens = counts
+        call = {
+            "time": round(time.time(), 3),
+            "kind": kind,
+            "model": model,
+            "prefix": prefix,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+        }
+        with self._lock:
+            self.calls.append(call)
+            totals = self._totals.setdefault(kind, {
+                "calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0
+            })
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["completion_tokens"] += completion_tokens
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(call) + "\n")
+
+    def stats(self):
+        """Totals, averages and cached-input share for every prompt kind"""
+        with self._lock:
+            totals = {kind: dict(values) for kind, values in self._totals.items()}
+        for values in totals.values():
+            calls, prompt_tokens = values["calls"], values["prompt_tokens"]
+            values["avg_prompt_tokens"] = round(prompt_tokens / calls, 1)
+            values["avg_completion_tokens"] = round(values["completion_tokens"] / calls, 1)
+            values["cached_ratio"] = round(values["cached_tokens"] / prompt_tokens, 3) if prompt_tokens else 0.0
+        return totals
@@ -0,0 +1,163 @@
+import json
+import re
+from dataclasses import asdict, dataclass
+
+# ============================================
+# STRUCTURED TRIAGE RESULT
+# ============================================
+
+TRIAGE_LEVELS = {
+    "red": "🔴 فوریت بحرانی (قرمز)",
+    "yellow": "🟡 فوریت متوسط (زرد)",
+    "green": "🟢 غیرفوری (سبز)",
+}
+CONFIDENCE_LEVELS = {"low": "پایین", "medium": "متوسط", "high": "بالا"}
+
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+TRIAGE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "triage": {"type": "string", "enum": list(TRIAGE_LEVELS)},
+        "diagnoses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "probability": {"type": "integer"},
+                    "reason": {"type": "string"},
+                },
+                "required": ["name", "probability", "reason"],
+                "additionalProperties": False,
+            },
+        },
+        "red_flags": _STRING_LIST,
+        "follow_up_questions": _STRING_LIST,
+        "advice": _STRING_LIST,
+        "confidence": {"type": "string", "enum": list(CONFIDENCE_LEVELS)},
+    },
+    "required": ["triage", "diagnoses", "red_flags", "follow_up_questions", "advice", "confidence"],
+    "additionalProperties": False,
+}
+
+# response_format argument for chat.completions.create
+TRIAGE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "triage", "strict": True, "schema": TRIAGE_SCHEMA},
+}
+
+
+@dataclass(slots=True)
+class Diagnosis:
+    name: str
+    probability: int
+    reason: str
+
+
+@dataclass(slots=True)
+class TriageResult:
+    triage: str
+    diagnoses: list
+    red_flags: list
+    follow_up_questions: list
+    advice: list
+    confidence: str
+
+    @property
+    def is_emergency(self):
+        return self.triage == "red"
+
+    def to_dict(self):
+        return asdict(self)
+
+    def to_json(self):
+        """Compact JSON for storage"""
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+    def to_markdown(self):
+        """Render the result as Markdown for history and reports"""
+        lines = [f"**سطح فوریت:** {TRIAGE_LEVELS[self.triage]}", "", "**تشخیص‌های احتمالی:**"]
+        lines += [
+            f"- {d.name} (احتمال {d.probability}%)" + (f": {d.reason}" if d.reason else "")
+            for d in self.diagnoses
+        ]
+        sections = (
+            ("⚠️ **علائم خطر:**", self.red_flags),
+            ("❓ **سوالات تکمیلی:**", self.follow_up_questions),
+            ("📌 **توصیه‌ها:**", self.advice),
+        )
+        for title, items in sections:
+            if items:
+                lines += ["", title] + [f"- {item}" for item in items]
+        lines += ["", f"📊 **سطح اطمینان تحلیل:** {CONFIDENCE_LEVELS[self.confidence]}"]
+        return "\n".join(lines)
+
+
+def _strings(value, field):
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"{field} must be a list of strings")
+    return [item.strip() for item in value if item.strip()]
+
+
+def parse_triage(text):
+    """Validate a model JSON answer into a TriageResult; raise ValueError if invalid"""
+    try:
+        data = json.loads(text)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Triage answer is not valid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError("Triage answer must be a JSON object")
+
+    triage = str(data.get("triage", "")).lower()
+    if triage not in TRIAGE_LEVELS:
+        raise ValueError(f"Unknown triage level: {triage!r}")
+    confidence = str(data.get("confidence", "")).lower()
+    if confidence not in CONFIDENCE_LEVELS:
+        raise ValueError(f"Unknown confidence level: {confidence!r}")
+
+    diagnoses = []
+    for item in data.get("diagnoses") or []:
+        if not isinstance(item, dict) or not item.get("name"):
+            raise ValueError("Each diagnosis needs a name")
+        try:
+            probability = int(item.get("probability", 0))
+        except (TypeError, ValueError) as e:
+            raise ValueError("Diagnosis probability must be an integer") from e
+        diagnoses.append(Diagnosis(
+            str(item["name"]).strip(),
+            min(max(probability, 0), 100),
+            str(item.get("reason", "")).strip()
+        ))
+    diagnoses.sort(key=lambda d: d.probability, reverse=True)
+
+    return TriageResult(
+        triage,
+        diagnoses,
+        _strings(data.get("red_flags", []), "red_flags"),
+        _strings(data.get("follow_up_questions", []), "follow_up_questions"),
+        _strings(data.get("advice", []), "advice"),
+        confidence
+    )
+
+
+def triage_from_dict(data):
+    """Rebuild a TriageResult from its stored dict form"""
+    return parse_triage(json.dumps(data))
+
+
+# Fields already complete in a JSON answer that is still streaming in
+_PARTIAL_LEVEL = re.compile(r'"triage"\s*:\s*"(red|yellow|green)"')
+_PARTIAL_NAME = re.compile(r'"name"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def partial_triage(text):
+    """Triage level and diagnosis names found so far in a streaming answer"""
+    level = _PARTIAL_LEVEL.search(text)
+    names = []
+    for name in _PARTIAL_NAME.findall(text):
+        try:
+            names.append(json.loads(f'"{name}"'))
+        except json.JSONDecodeError:
+            break
+    return (level.group(1) if level else None), names
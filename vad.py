@@ -0,0 +1,97 @@
+from collections import namedtuple
+
+import numpy as np
+
+# ============================================
+# VOICE ACTIVITY DETECTION
+# ============================================
+
+VadResult = namedtuple(
+    "VadResult",
+    "audio speech_ratio seconds_removed original_seconds"
+)
+
+
+def frame_features(signal, frame_len):
+    """Short-time energy and zero-crossing rate for non-overlapping frames"""
+    n_frames = len(signal) // frame_len
+    frames = signal[:n_frames * frame_len].reshape(n_frames, frame_len)
+    energy = np.einsum("ij,ij->i", frames, frames) / frame_len
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_len - 1)
+    return energy, zcr
+
+
+def _dilate(mask, before, after):
+    """Extend every True frame by a number of frames before and after it"""
+    if not mask.any() or (before == 0 and after == 0):
+        return mask
+    kernel = np.ones(before + after + 1)
+    spread = np.convolve(mask.astype(np.float32), kernel)
+    return spread[before:before + len(mask)] > 0
+
+
+def speech_mask(signal, samplerate, frame_ms=20, margin_db=10.0, min_energy=1e-5,
+                zcr_threshold=0.25, hangover_ms=200, preroll_ms=100):
+    """Classify frames as speech from energy and ZCR, with hangover
+
+    The energy threshold sits margin_db above the recording's noise floor
+    (10th percentile of frame energy), but at most margin_db below the
+    loudest frame so clips that are nearly all speech are kept, and never
+    below min_energy (-50 dBFS by default). Low-energy frames with a high
+    zero-crossing rate count as speech to keep unvoiced fricatives.
+    """
+    frame_len = max(int(samplerate * frame_ms / 1000), 2)
+    energy, zcr = frame_features(signal, frame_len)
+    if len(energy) == 0:
+        return np.zeros(0, dtype=bool), frame_len
+    noise_floor = np.percentile(energy, 10)
+    margin = 10 ** (margin_db / 10)
+    threshold = max(min(noise_floor * margin, energy.max() / margin), min_energy)
+    speech = (energy > threshold) | ((energy > threshold * 0.25) & (zcr > zcr_threshold))
+    hangover = int(hangover_ms / frame_ms)
+    preroll = int(preroll_ms / frame_ms)
+    return _dilate(speech, preroll, hangover), frame_len
+
+
+def trim_silence(audio, samplerate, max_pause_ms=600, **options):
+    """Trim leading/trailing silence and shorten long internal pauses
+
+    audio is a mono (or (frames, 1)) float signal. Internal pauses longer
+    than max_pause_ms are cut down to max_pause_ms, keeping half of the
+    allowance on each side of the cut. When no speech is found the audio is
+    returned unchanged with a speech ratio of 0.
+    """
+    signal = np.asarray(audio, dtype=np.float32).reshape(-1)
+    original_seconds = len(signal) / samplerate
+    speech, frame_len = speech_mask(signal, samplerate, **options)
+    if not speech.any():
+        return VadResult(signal, 0.0, 0.0, original_seconds)
+
+    # Runs of consecutive silent frames, as [start, end) frame indices
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], (~speech).view(np.int8), [0]))))
+    starts, ends = edges[::2], edges[1::2]
+    keep = speech.copy()
+    max_pause = int(max_pause_ms / (1000 * frame_len / samplerate))
+    head = max_pause // 2
+    for start, end in zip(starts, ends):
+        if start == 0 or end == len(speech):
+            continue  # leading/trailing silence is dropped entirely
+        if end - start <= max_pause:
+            keep[start:end] = True
+        else:
+            keep[start:start + head] = True
+            keep[end - (max_pause - head):end] = True
+
+    # Samples past the last whole frame follow that frame's decision
+    sample_keep = np.repeat(keep, frame_len)
+    tail = len(signal) - len(sample_keep)
+    if tail:
+        sample_keep = np.concatenate((sample_keep, np.full(tail, keep[-1])))
+    trimmed = signal[sample_keep]
+    return VadResult(
+        trimmed,
+        float(speech.mean()),
+        (len(signal) - len(trimmed)) / samplerate,
+        original_seconds
+    )
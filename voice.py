@@ -1,200 +1,634 @@
 import streamlit as st
-import sounddevice as sd
-import numpy as np
-import wavio
-from openai import OpenAI
 import os
 from datetime import datetime
+import time
 import json
 import base64
+import functools
+import uuid
 from dotenv import load_dotenv
+from core import (
+    DOCTOR_QUESTIONS_PROMPT,
+    EMERGENCY_PROTOCOL,
+    PATIENT_ANALYSIS_PROMPT,
+    ask_model_stream,
+    ask_triage,
+    check_recording,
+    conversation_prompt,
+    doctor_panel_prompts,
+    format_prompt,
+    get_metrics,
+    get_red_flag_matcher,
+    get_response_cache,
+    get_scheduler,
+    get_single_flight,
+    is_emergency,
+    is_model_error,
+    prepare_recording,
+    summarize_conversation,
+    transcribe_audio
+)
+import audio_quality
+from case_queue import CaseQueue
+from consultation_store import ConsultationStore
+from conversation import Conversation, format_turns
+from triage import CONFIDENCE_LEVELS, TRIAGE_LEVELS, partial_triage, triage_from_dict
+from speculation import SpeculativeJobs, case_key, consume_stream, make_executor
+from profiler import RerunProfiler
+from similar_cases import SimilarCaseIndex, negations
+from report_jobs import STAGE_LABELS, ReportJobs
+
+
+@st.cache_resource
+def get_settings():
+    """Load the .env file once per process instead of on every rerun"""
+    # 🔑 API Configuration - Load from .env file
+    load_dotenv()
+    return os.getenv("OPENAI_API_KEY"), os.getenv("OPENAI_BASE_URL")
 
-# 🔑 API Configuration - Load from .env file
-load_dotenv()
 
 # Get API key and base URL from environment variables
-api_key = os.getenv("OPENAI_API_KEY")
-base_url = os.getenv("OPENAI_BASE_URL")
+api_key, base_url = get_settings()
 
 if not api_key or not base_url:
+    get_settings.clear()  # pick up the .env file once it has been created
     st.error("❌ خطا: لطفاً فایل .env را ایجاد کنید و OPENAI_API_KEY و OPENAI_BASE_URL را تنظیم کنید.")
     st.stop()
 
 os.environ["OPENAI_API_KEY"] = api_key
 os.environ["OPENAI_BASE_URL"] = base_url
 
-client = OpenAI()
+response_cache = get_response_cache()
+red_flag_matcher = get_red_flag_matcher()
 
-# ============================================
-# ENHANCED SYSTEM PROMPTS
-# ============================================
 
-PATIENT_ANALYSIS_PROMPT = """
-شما یک سیستم هوش مصنوعی پزشکی پیشرفته هستید که به عنوان دستیار اورژانس عمل می‌کنید.
+@st.cache_resource
+def get_consultation_store():
+    """Open the durable consultation store once per process"""
+    return ConsultationStore(os.getenv("CONSULTATION_DB_PATH", "consultations.sqlite3"))
 
-## اطلاعات بیمار:
-علائم گزارش شده: {symptoms}
-تاریخ و زمان: {timestamp}
 
-## وظایف شما (به ترتیب اولویت):
+consultation_store = get_consultation_store()
 
-### 1️⃣ ارزیابی فوریت (TRIAGE)
-بر اساس پروتکل‌های استاندارد اورژانس، وضعیت را طبقه‌بندی کنید:
 
-🔴 **فوریت بحرانی (قرمز)**: نیاز به مراجعه فوری به اورژانس (0-1 ساعت)
-🟡 **فوریت متوسط (زرد)**: مراجعه به پزشک در 24 ساعت آینده
-🟢 **غیرفوری (سبز)**: قابل پیگیری با پزشک خانواده
+@st.cache_resource
+def get_similar_case_index():
+    """Open the similar-case index and catch it up with the store once per process"""
+    index = SimilarCaseIndex(
+        os.getenv("SIMILAR_CASE_INDEX_PATH", "similar_cases"),
+        dim=int(os.getenv("SIMILAR_CASE_DIM", "2048"))
+    )
+    index.sync(consultation_store)
+    return index
 
-### 2️⃣ تشخیص‌های احتمالی (Differential Diagnosis)
-لیست 3-5 تشخیص محتمل با درصد احتمال به این صورت:
 
-**تشخیص اول (احتمال XX%):**
-- نام بیماری: [نام به فارسی و انگلیسی]
-- دلیل: [چرا این تشخیص محتمل است]
-- علائم کلیدی: [علائمی که با این بیماری همخوانی دارند]
+similar_case_index = get_similar_case_index()
 
-### 3️⃣ علائم خطر (Red Flags) ⚠️
-اگر هر یک از این علائم ظاهر شد، فوراً به اورژانس مراجعه کنید:
-- [لیست علائم خطرناک مرتبط]
+# A reviewed analysis of a case at least this similar is reused (above 1 disables)
+SIMILAR_CASE_REUSE_THRESHOLD = float(os.getenv("SIMILAR_CASE_REUSE_THRESHOLD", "0.98"))
 
-### 4️⃣ سوالات تکمیلی برای تشخیص دقیق‌تر
-برای تشخیص بهتر، لطفاً به این سوالات پاسخ دهید:
-1. [سوال مهم اول]
-2. [سوال مهم دوم]
-3. [سوال مهم سوم]
 
-### 5️⃣ توصیه‌های اولیه
-📌 اقدامات خانگی:
-- [توصیه 1]
-- [توصیه 2]
+@st.cache_resource
+def get_case_queue():
+    """Open the case queue shared by patient and doctor sessions once per process"""
+    return CaseQueue(
+        os.getenv("CASE_QUEUE_PATH", "cases.sqlite3"),
+        claim_lease=float(os.getenv("CASE_CLAIM_LEASE_SECONDS", "1800")),
+        poll_interval=float(os.getenv("CASE_QUEUE_WATCH_SECONDS", "0.5"))
+    )
 
-💊 داروهای بدون نسخه (در صورت نیاز):
-- [دارو با دوز و هشدارها]
 
-🚫 موارد ممنوع:
-- [کارهایی که نباید انجام دهد]
+case_queue = get_case_queue()
 
-### 6️⃣ برنامه پیگیری
-- بررسی مجدد علائم در [مدت زمان]
-- در صورت بدتر شدن: [راهنمایی]
+# How often a doctor's queue checks for changes (an in-memory version check)
+CASE_QUEUE_POLL_SECONDS = float(os.getenv("CASE_QUEUE_POLL_SECONDS", "2"))
 
----
-⚠️ **مهم:** این ارزیابی جایگزین معاینه پزشکی نیست.
-📊 **سطح اطمینان تحلیل:** [پایین/متوسط/بالا]
-"""
+HISTORY_PAGE_SIZE = 10
 
-DOCTOR_QUESTIONS_PROMPT = """
-شما یک پزشک متخصص با تجربه بالا هستید.
+# Profiler section for each role's panel
+ROLE_SECTIONS = {"بیمار": "patient", "پزشک": "doctor"}
 
-## اطلاعات موجود:
-علائم بیمار: {symptoms}
+# Precompute doctor-panel analyses as soon as the patient submits symptoms
+SPECULATION_DEFAULT = os.getenv("SPECULATIVE_ANALYSIS", "1") != "0"
 
-## وظیفه:
-برای تشخیص دقیق، سوالات تکمیلی حرفه‌ای بپرسید.
 
-### قالب سوالات:
+# Transcribe finished segments while the patient is still speaking
+INCREMENTAL_TRANSCRIPTION = os.getenv("INCREMENTAL_TRANSCRIPTION", "1") != "0"
 
-**📋 بخش 1: تاریخچه دقیق علائم**
-1. **زمان شروع:** این علائم از چه زمانی شروع شده؟ آیا ناگهانی بوده؟
-2. **الگوی علائم:** دائمی است یا موقت؟ چه زمانی بدتر می‌شود؟
 
-**📋 بخش 2: شدت و کیفیت**
-3. **مقیاس شدت:** در مقیاس 1 تا 10 چقدر است؟
-4. **نوع احساس:** تیز، سوزاننده، فشاری، یا کند کننده؟
+@st.cache_resource
+def get_transcription_executor():
+    """Create the shared thread pool for segment transcription"""
+    import chunked_transcription
+    return chunked_transcription.make_executor(int(os.getenv("TRANSCRIPTION_WORKERS", "3")))
 
-**📋 بخش 3: عوامل تشدیدکننده**
-5. **چه چیزی وضعیت را بهتر/بدتر می‌کند؟**
 
-**📋 بخش 4: علائم همراه**
-6. **سایر علائم:** تب، لرز، تغییر اشتها، وزن، خواب؟
+# Ask for a typed JSON triage instead of the free-text analysis
+STRUCTURED_TRIAGE = os.getenv("STRUCTURED_TRIAGE", "1") != "0"
 
-**📋 بخش 5: سابقه پزشکی**
-7. **تاریخچه:** آیا قبلاً علائم مشابه داشته‌اید؟ بیماری زمینه‌ای؟ داروهای مصرفی؟
 
-**📋 بخش 6: سبک زندگی**
-8. **محیط:** سفر اخیر؟ تماس با بیماران؟ تغییر در رژیم غذایی؟
+# Token budget of the follow-up conversation's summary plus recent turns
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "1500"))
+CONVERSATION_KEEP_TURNS = int(os.getenv("CONVERSATION_KEEP_TURNS", "4"))
 
----
-💡 **هدف:** با پاسخ به این سوالات، تشخیص دقیق‌تری ممکن می‌شود.
-"""
 
-EMERGENCY_PROTOCOL = """
-🚨 پروتکل اورژانس - ارزیابی سریع
+@st.cache_resource
+def get_speculation_executor():
+    """Create the shared thread pool for speculative doctor-panel jobs"""
+    return make_executor(int(os.getenv("SPECULATIVE_WORKERS", "4")))
 
-علائم: {symptoms}
 
-## ❗ بررسی فوری علائم خطرناک:
+@st.cache_resource
+def get_report_jobs():
+    """Open the report job table and its worker pool once per process"""
+    return ReportJobs(
+        os.getenv("REPORT_DB_PATH", "reports.sqlite3"),
+        max_workers=int(os.getenv("REPORT_WORKERS", "2")),
+        max_age=float(os.getenv("REPORT_MAX_AGE_SECONDS", "3600"))
+    )
 
-### ⚠️ Red Flags (علائم خطر فوری):
 
-**قلبی-عروقی:**
-✋ درد قفسه سینه + تعریق → حمله قلبی احتمالی
-✋ تپش قلب شدید + بیهوشی
+# How often a pending report's progress is refreshed
+REPORT_POLL_SECONDS = float(os.getenv("REPORT_POLL_SECONDS", "1.5"))
 
-**عصبی:**
-✋ فلج ناگهانی یک طرفه → سکته مغزی
-✋ سردرد رعدآسا شدید
-✋ اختلال هوشیاری
 
-**تنفسی:**
-✋ تنگی نفس شدید
-✋ کبودی لب‌ها
-✋ سرفه خونی
+@st.cache_resource
+def get_rerun_profiler():
+    """Create the process-wide rerun profiler (RERUN_PROFILE=1 to enable)"""
+    return RerunProfiler(
+        enabled=os.getenv("RERUN_PROFILE", "0") == "1",
+        log_path=os.getenv("RERUN_PROFILE_LOG") or None
+    )
 
-**گوارشی:**
-✋ درد شکم ناگهانی و شدید
-✋ استفراغ خونی
 
-**سایر:**
-✋ خونریزی شدید
-✋ واکنش آلرژیک شدید
-✋ تب بالای 40 درجه
+@st.cache_resource
+def get_stage_metrics():
+    """Stage metrics, served on METRICS_PORT for Prometheus when enabled"""
+    metrics = get_metrics()
+    port = os.getenv("METRICS_PORT")
+    if metrics.enabled and port:
+        metrics.serve(os.getenv("METRICS_HOST", "127.0.0.1"), int(port))
+    return metrics
 
-## تصمیم‌گیری:
 
-**وجود علائم بالا:**
-🚨 تماس فوری با اورژانس 115
+metrics = get_stage_metrics()
 
-**وضعیت پایدار:**
-📞 مشاوره پزشکی
-"""
+rerun_profiler = get_rerun_profiler()
+rerun = rerun_profiler.rerun()
 
 
 # ============================================
 # HELPER FUNCTIONS
 # ============================================
 
-def ask_model(prompt, model="gpt-4o-mini"):
-    """Send request to AI model with enhanced error handling"""
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=2000
+def render_model_stream(prompt, box="info", refresh_interval=0.05, use_cache=True, priority="patient"):
+    """Render a streamed answer into a result box and return the full text"""
+    placeholder = st.empty()
+    show = getattr(placeholder, box)
+    parts = []
+    last_render = 0.0
+    render_seconds = 0.0
+    for chunk in ask_model_stream(prompt, use_cache=use_cache, priority=priority):
+        parts.append(chunk)
+        # Throttle re-renders so long answers don't flood the websocket
+        now = time.monotonic()
+        if now - last_render >= refresh_interval:
+            show("".join(parts) + " ▌")
+            last_render = time.monotonic()
+            render_seconds += last_render - now
+    text = "".join(parts)
+    now = time.monotonic()
+    show(text)
+    metrics.observe("render", render_seconds + time.monotonic() - now)
+    return text
+
+
+def render_triage(result):
+    """Render a structured triage result"""
+    level = TRIAGE_LEVELS[result.triage]
+    if result.triage == "red":
+        st.error(f"### {level}")
+    elif result.triage == "yellow":
+        st.warning(f"### {level}")
+    else:
+        st.success(f"### {level}")
+
+    st.markdown("**🩺 تشخیص‌های احتمالی:**")
+    for diagnosis in result.diagnoses:
+        st.progress(diagnosis.probability / 100, text=f"{diagnosis.name} — {diagnosis.probability}%")
+        if diagnosis.reason:
+            st.caption(diagnosis.reason)
+    if result.red_flags:
+        st.markdown("**⚠️ علائم خطر (در صورت بروز فوراً به اورژانس مراجعه کنید):**")
+        st.markdown("\n".join(f"- {flag}" for flag in result.red_flags))
+    if result.follow_up_questions:
+        st.markdown("**❓ سوالات تکمیلی:**")
+        st.markdown("\n".join(f"{i}. {q}" for i, q in enumerate(result.follow_up_questions, 1)))
+    if result.advice:
+        st.markdown("**📌 توصیه‌های اولیه:**")
+        st.markdown("\n".join(f"- {item}" for item in result.advice))
+    st.caption(f"📊 سطح اطمینان تحلیل: {CONFIDENCE_LEVELS[result.confidence]}")
+    st.caption("⚠️ این ارزیابی جایگزین معاینه پزشکی نیست.")
+
+
+def render_triage_stream(symptoms, priority="patient", refresh_interval=0.05):
+    """Request the structured triage, showing what has arrived while it streams"""
+    placeholder = st.empty()
+    last_render = 0.0
+
+    def show_progress(text):
+        nonlocal last_render
+        # Throttled like render_model_stream; only completed fields are shown
+        now = time.monotonic()
+        if now - last_render < refresh_interval:
+            return
+        level, names = partial_triage(text)
+        lines = ["⏳ در حال تحلیل علائم..."]
+        if level:
+            lines.append(f"**سطح فوریت:** {TRIAGE_LEVELS[level]}")
+        if names:
+            lines.append("**تشخیص‌های احتمالی:** " + "، ".join(names) + " ▌")
+        placeholder.info("\n\n".join(lines))
+        last_render = time.monotonic()
+
+    result = ask_triage(symptoms, priority=priority, on_chunk=show_progress)
+    placeholder.empty()
+    return result
+
+
+def run_speculative_prompt(prompt, priority, cancelled):
+    """Background job: fetch a full answer unless the case is superseded"""
+    return consume_stream(ask_model_stream(prompt, priority=priority), cancelled)
+
+
+def start_speculative_analyses(symptoms, urgent=False):
+    """Precompute the doctor-panel answers for a new case in the background"""
+    if "speculative_jobs" not in st.session_state:
+        st.session_state.speculative_jobs = SpeculativeJobs(get_speculation_executor())
+    jobs = st.session_state.speculative_jobs
+    if not st.session_state.get("speculation_enabled", SPECULATION_DEFAULT):
+        jobs.cancel()
+        return
+    prompts = doctor_panel_prompts(symptoms)
+    # Red-flag cases get the emergency protocol queued ahead of follow-ups
+    order = ["emergency", "questions"] if urgent else ["questions", "emergency"]
+    priority = "red_flag" if urgent else "follow_up"
+    jobs.start(case_key(symptoms), {
+        name: functools.partial(run_speculative_prompt, prompts[name], priority)
+        for name in order
+    })
+
+
+def similar_consultations(symptoms, k=5, min_score=0.3):
+    """Past consultations most similar to a case, as (summary, score) pairs"""
+    # New consultations are appended to the index on the way
+    similar_case_index.sync(consultation_store)
+    matches = similar_case_index.search(symptoms, k=k, min_score=min_score)
+    summaries = consultation_store.get_summaries(match.consultation_id for match in matches)
+    return [
+        (summaries[match.consultation_id], match.score)
+        for match in matches
+        if match.consultation_id in summaries
+    ]
+
+
+def find_reviewed_analysis(symptoms):
+    """A doctor-reviewed patient analysis of a near-identical case, or None
+
+    Character n-grams miss negation and red-flag wording, so a match is
+    reused only if it negates the same words and matches no red flag.
+    """
+    if SIMILAR_CASE_REUSE_THRESHOLD > 1:
+        return None
+    negated = negations(symptoms)
+    # Searched wide: near-duplicate unreviewed cases must not crowd out a reviewed one
+    for summary, score in similar_consultations(symptoms, k=50, min_score=SIMILAR_CASE_REUSE_THRESHOLD):
+        if not summary.reviewed or summary.role != "بیمار":
+            continue
+        if negations(summary.symptoms) == negated and not red_flag_matcher.match(summary.symptoms):
+            return summary, score
+    return None
+
+
+def review_checkbox(summary, key):
+    """Let a doctor mark a stored patient analysis as reviewed"""
+    # Reviewed analyses may be reused for near-identical new cases
+    reviewed = st.checkbox(
+        "✅ تحلیل توسط پزشک بررسی و تأیید شد",
+        value=bool(summary.reviewed),
+        key=key
+    )
+    if reviewed != bool(summary.reviewed):
+        consultation_store.set_reviewed(summary.id, reviewed)
+
+
+def show_red_flag_alert(flags):
+    """Show the 115 alert for locally matched red flags"""
+    items = "\n".join(f"- {flag.label} ({flag.category})" for flag in flags)
+    st.error(
+        "🚨 **هشدار فوری: علائم خطر شناسایی شد!**\n\n"
+        f"{items}\n\n"
+        "📞 لطفاً همین حالا با اورژانس **115** تماس بگیرید."
+    )
+
+
+def render_doctor_answer(name, prompt, box="info", priority="follow_up"):
+    """Show a precomputed doctor-panel answer, or stream it on demand"""
+    jobs = st.session_state.get("speculative_jobs")
+    future = None
+    if jobs is not None:
+        future = jobs.future(case_key(st.session_state.patient_symptoms), name)
+    if future is not None and future.done() and not future.cancelled():
+        try:
+            answer = future.result()
+        except Exception:
+            answer = None
+        # A failed speculation is a miss, never an answer to show
+        if answer and not is_model_error(answer):
+            getattr(st, box)(answer)
+            return answer
+    # A job still running is joined live: single-flight shares its stream
+    return render_model_stream(prompt, box=box, priority=priority)
+
+
+def finished_panel_answers(symptoms):
+    """Doctor-panel answers already computed for a case, without waiting"""
+    parts = {"analysis": st.session_state.analysis_result}
+    jobs = st.session_state.get("speculative_jobs")
+    for name in ("questions", "emergency"):
+        future = jobs.future(case_key(symptoms), name) if jobs is not None else None
+        if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+            parts[name] = future.result()
+    return parts
+
+
+@st.fragment(run_every=REPORT_POLL_SECONDS)
+def show_report_progress(job_id):
+    """Poll a pending report without rerunning the rest of the page"""
+    job = get_report_jobs().get(job_id)
+    if job is not None and job.status in ("queued", "running"):
+        st.progress(job.progress, text=f"🔄 در حال تولید گزارش جامع... {STAGE_LABELS.get(job.stage, '')}")
+    else:
+        st.rerun()  # show the finished report and stop polling
+
+
+def submit_report(priority, regenerate=False):
+    """Start (or join) the background report for the current case"""
+    # Sections computed so far are reused
+    symptoms = st.session_state.patient_symptoms
+    st.session_state.report_job = (case_key(symptoms), get_report_jobs().submit(
+        symptoms,
+        parts=finished_panel_answers(symptoms),
+        priority=priority,
+        session_id=st.session_state.session_id,
+        regenerate=regenerate
+    ))
+
+
+def render_report(job_id, priority="follow_up"):
+    """Show the state of a report job, with downloads once it is ready"""
+    job = get_report_jobs().get(job_id)
+    if job is None:
+        return
+    if job.status in ("queued", "running"):
+        show_report_progress(job_id)
+    elif job.status == "failed":
+        st.error(f"❌ تولید گزارش ناموفق بود: {job.error}")
+    else:
+        st.success("✅ گزارش جامع آماده است")
+        with st.expander("📄 مشاهده گزارش", expanded=True):
+            st.markdown(job.markdown)
+        download_md, download_html = st.columns(2)
+        with download_md:
+            st.download_button("⬇️ دریافت Markdown", job.markdown, file_name=f"report-{job.id[:8]}.md",
+                               mime="text/markdown")
+        with download_html:
+            st.download_button("⬇️ دریافت HTML", job.html, file_name=f"report-{job.id[:8]}.html",
+                               mime="text/html")
+        if st.button("🔄 تولید مجدد گزارش", key=f"regenerate_report_{job.id}"):
+            submit_report(priority, regenerate=True)
+            st.rerun()
+
+
+def get_conversation():
+    """The follow-up conversation of the current case, started on first use"""
+    symptoms = st.session_state.patient_symptoms
+    conversation = st.session_state.get("conversation")
+    if conversation is None or conversation.symptoms != symptoms:
+        conversation = Conversation(
+            symptoms,
+            st.session_state.analysis_result,
+            token_budget=CONVERSATION_TOKEN_BUDGET,
+            keep_turns=CONVERSATION_KEEP_TURNS
         )
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"❌ خطا در ارتباط با مدل: {str(e)}"
+        # The structured triage's questions open the conversation
+        triage = st.session_state.triage_result
+        if triage is not None and triage.follow_up_questions:
+            conversation.add("assistant", "\n".join(f"- {q}" for q in triage.follow_up_questions))
+        st.session_state.conversation = conversation
+    return conversation
 
 
-def save_consultation(symptoms, analysis, role):
-    """Save consultation to session history"""
-    if "consultation_history" not in st.session_state:
-        st.session_state.consultation_history = []
-    
+def render_follow_up_conversation():
+    """Let the patient answer follow-up questions and get an updated assessment"""
+    conversation = get_conversation()
+    st.markdown("---")
+    st.markdown("### 💬 گفتگوی پیگیری")
+    transcript = st.container()
+    with transcript:
+        for turn in conversation.turns:
+            with st.chat_message("user" if turn.role == "patient" else "assistant"):
+                st.markdown(turn.content)
+
+    with st.form("follow_up_form", clear_on_submit=True):
+        answer = st.text_area("پاسخ یا توضیح تکمیلی خود را بنویسید:", height=80)
+        submitted = st.form_submit_button("📤 ارسال پاسخ")
+    if submitted and answer.strip():
+        answer = answer.strip()
+        flags = red_flag_matcher.match(answer)
+        summarize = functools.partial(summarize_conversation, priority="follow_up")
+        conversation.add("patient", answer)
+        with transcript:
+            with st.chat_message("user"):
+                st.markdown(answer)
+            if flags:
+                show_red_flag_alert(flags)
+            # A fold started after the previous reply has usually finished by now
+            conversation.compact(summarize, get_speculation_executor(), wait=True)
+            with st.chat_message("assistant"):
+                reply = render_model_stream(
+                    conversation_prompt(conversation),
+                    priority="red_flag" if flags else "patient"
+                )
+        if not is_model_error(reply):
+            conversation.add("assistant", reply)
+            # Fold older turns while the patient reads, off the next turn's path
+            conversation.compact(summarize, get_speculation_executor(), wait=False)
+    st.caption(
+        f"🧮 حجم زمینه گفتگو: حدود {conversation.context_tokens()} از {conversation.token_budget} توکن "
+        f"(خلاصه‌سازی: {conversation.folds} بار)"
+    )
+
+
+def load_queued_case(case):
+    """Make a claimed case the doctor panel's current case"""
+    st.session_state.claimed_case = case.id
+    st.session_state.patient_symptoms = case.symptoms
+    st.session_state.analysis_result = case.analysis
+    st.session_state.triage_result = triage_from_dict(json.loads(case.triage_json)) if case.triage_json else None
+    start_speculative_analyses(case.symptoms, urgent=case.urgency == 0)
+
+
+@st.fragment(run_every=CASE_QUEUE_POLL_SECONDS)
+def render_case_queue():
+    """Cases from every patient session, re-read only when the queue changed"""
+    doctor_id = st.session_state.session_id
+    if st.session_state.get("case_queue_seen") != case_queue.version:
+        # Note the version first so a change during the query is not missed
+        st.session_state.case_queue_seen = case_queue.version
+        st.session_state.case_queue_cases = case_queue.pending(doctor_id)
+    cases = st.session_state.case_queue_cases
+
+    st.markdown("### 📥 صف بیماران")
+    if not cases:
+        st.caption("در حال حاضر پرونده‌ای در صف نیست.")
+        return
+    for case in cases:
+        mine = case.status == "claimed" and case.claimed_by == doctor_id
+        if mine and case.id == st.session_state.get("claimed_case") and case.analysis \
+                and st.session_state.analysis_result is None:
+            # The analysis arrived after the case was claimed
+            load_queued_case(case)
+            st.rerun()
+        level = "🚨 علائم خطر" if case.red_flags else TRIAGE_LEVELS.get(case.triage, "⏳ در انتظار تحلیل")
+        waited = int((time.time() - case.submitted) // 60)
+        preview = case.symptoms if len(case.symptoms) <= 80 else case.symptoms[:80] + "…"
+        info, action = st.columns([4, 1])
+        with info:
+            st.markdown(f"**#{case.id}** {level} · {waited} دقیقه پیش  \n{preview}")
+        with action:
+            if st.button("📂 باز کردن" if mine else "🙋 برداشتن", key=f"claim_case_{case.id}"):
+                if case_queue.claim(case.id, doctor_id):
+                    load_queued_case(case_queue.get(case.id))
+                    st.rerun()
+                else:
+                    st.warning("این پرونده را پزشک دیگری برداشته است.")
+
+
+def start_consultation_trace():
+    """Begin the trace of a new consultation (no-op unless tracing is on)"""
+    trace = metrics.new_trace()
+    st.session_state.consultation_trace = trace
+    metrics.bind(trace)
+
+
+def analyze_patient_symptoms(text, emergency_key):
+    """Stream the patient analysis, store it and raise the emergency alert"""
+    with metrics.span("analysis"):
+        analysis = _analyze_patient_symptoms(text, emergency_key)
+    # The consultation is complete once its analysis has been shown
+    metrics.finish_trace(st.session_state.pop("consultation_trace", None))
+    return analysis
+
+
+def _analyze_patient_symptoms(text, emergency_key):
+    # Local red-flag rules alert before any model call is made
+    flags = red_flag_matcher.match(text)
+    if flags:
+        show_red_flag_alert(flags)
+    start_speculative_analyses(text, urgent=bool(flags))
+    # Doctors see the case (red flags first) while it is still being analysed
+    case_id = case_queue.publish(
+        text,
+        red_flags=[flag.id for flag in flags],
+        session_id=st.session_state.session_id
+    )
+    # Red-flag cases jump the shared request queue
+    priority = "red_flag" if flags else "patient"
+
+    st.markdown("### 📋 نتیجه تحلیل:")
+    # A doctor-reviewed analysis of a near-identical case replaces the model
+    # call; red-flag cases always get a fresh analysis
+    reused = None if flags else find_reviewed_analysis(text)
+    triage = None
+    if reused is not None:
+        summary, score = reused
+        analysis, triage_dict = consultation_store.get_analysis(summary.id)
+        triage = triage_from_dict(triage_dict) if triage_dict else None
+        st.caption(f"♻️ تحلیل یک مورد بسیار مشابه که پزشک تأیید کرده است (شباهت {score:.0%})")
+    elif STRUCTURED_TRIAGE:
+        triage = render_triage_stream(text, priority=priority)
+    if triage is not None:
+        with metrics.span("render"):
+            render_triage(triage)
+        analysis = triage.to_markdown()
+        urgent = triage.is_emergency
+    elif reused is not None:
+        st.info(analysis)
+        urgent = is_emergency(analysis)
+    else:
+        # Free-text analysis when structured mode is off or its answer was invalid
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        prompt = format_prompt(
+            PATIENT_ANALYSIS_PROMPT,
+            symptoms=text,
+            timestamp=timestamp
+        )
+        analysis = render_model_stream(prompt, priority=priority)
+        urgent = is_emergency(analysis)
+    st.session_state.analysis_result = analysis
+    st.session_state.triage_result = triage
+
+    # Save to history; a failed model call is shown but never stored as an analysis
+    if not is_model_error(analysis):
+        save_consultation(text, analysis, "بیمار", triage=triage)
+        case_queue.update(
+            case_id,
+            triage=triage.triage if triage else ("red" if urgent else None),
+            analysis=analysis,
+            triage_json=triage.to_json() if triage else None
+        )
+
+    show_emergency_actions(flags, urgent, emergency_key)
+    return analysis
+
+
+def show_emergency_actions(flags, urgent, emergency_key):
+    """Warn about an urgent case and offer the 115 call button"""
+    if flags or urgent:
+        if not flags:
+            st.error("⚠️ **هشدار:** احتمال نیاز به مراجعه فوری!")
+        if st.button("📞 تماس با اورژانس 115", key=emergency_key):
+            st.error("لطفاً فوراً با شماره 115 تماس بگیرید")
+
+
+def show_patient_analysis(emergency_key):
+    """Show the stored analysis again on reruns, without new model calls"""
+    analysis = st.session_state.analysis_result
+    triage = st.session_state.triage_result
+    flags = red_flag_matcher.match(st.session_state.patient_symptoms)
+    if flags:
+        show_red_flag_alert(flags)
+    st.markdown("### 📋 نتیجه تحلیل:")
+    if triage is not None:
+        render_triage(triage)
+        urgent = triage.is_emergency
+    else:
+        st.info(analysis)
+        urgent = is_emergency(analysis)
+    show_emergency_actions(flags, urgent, emergency_key)
+
+
+def save_consultation(symptoms, analysis, role, triage=None):
+    """Save consultation to the durable history store"""
     consultation = {
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "role": role,
         "symptoms": symptoms,
-        "analysis": analysis
+        "analysis": analysis,
+        "triage": triage.to_dict() if triage else None
     }
-    st.session_state.consultation_history.append(consultation)
-
-
-def format_prompt(template, **kwargs):
-    """Format prompt template with parameters"""
-    return template.format(**kwargs)
+    consultation_store.add(consultation, session_id=st.session_state.get("history_id"))
 
 
 # ============================================
@@ -209,7 +643,7 @@ st.set_page_config(
 )
 
 # Custom CSS for better styling
-st.markdown("""
+PAGE_CSS = """
 <style>
     .main-header {
         text-align: center;
@@ -258,7 +692,26 @@ st.markdown("""
         border: 1px solid #bee5eb;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+@st.cache_resource
+def get_logo_html(path):
+    """Read and base64-encode the logo once per process; None if it is missing"""
+    try:
+        with open(path, "rb") as f:
+            encoded = base64.b64encode(f.read()).decode("ascii")
+    except OSError:
+        return None
+    return (
+        '<div style="text-align: center;">'
+        f'<img src="data:image/png;base64,{encoded}" style="width: 100%; border-radius: 10px;">'
+        '</div>'
+    )
+
+
+# Streamlit drops elements that a rerun does not emit, so the CSS is sent every time
+st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
 # ============================================
 # MAIN APPLICATION
@@ -280,18 +733,30 @@ if "patient_symptoms" not in st.session_state:
     st.session_state.patient_symptoms = None
 if "analysis_result" not in st.session_state:
     st.session_state.analysis_result = None
-if "consultation_history" not in st.session_state:
-    st.session_state.consultation_history = []
+if "triage_result" not in st.session_state:
+    st.session_state.triage_result = None
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if "history_id" not in st.session_state:
+    # Consultation history is keyed on an id kept in the page URL, so it
+    # survives reloads and returns when the same link is opened again
+    history_id = st.query_params.get("history")
+    if not history_id:
+        history_id = uuid.uuid4().hex
+        st.query_params["history"] = history_id
+    st.session_state.history_id = history_id
+# Spans of this rerun belong to the consultation in progress, if any
+metrics.bind(st.session_state.get("consultation_trace"))
+
+rerun.lap("setup")
 
 # Sidebar
 with st.sidebar:
     # Display logo at the top of sidebar
-    try:
-        if os.path.exists(LOGO_PATH):
-            st.image(LOGO_PATH, use_container_width=True)
-        else:
-            st.markdown('<div style="text-align: center; font-size: 60px; padding: 20px;">🏥</div>', unsafe_allow_html=True)
-    except:
+    logo_html = get_logo_html(LOGO_PATH)
+    if logo_html:
+        st.markdown(logo_html, unsafe_allow_html=True)
+    else:
         st.markdown('<div style="text-align: center; font-size: 60px; padding: 20px;">🏥</div>', unsafe_allow_html=True)
     
     st.markdown("---")
@@ -304,11 +769,42 @@ with st.sidebar:
         key="role_selector"
     )
     
+    st.checkbox(
+        "⚡ پیش‌محاسبه تحلیل‌های پنل پزشک",
+        value=SPECULATION_DEFAULT,
+        key="speculation_enabled",
+        help="سوالات تکمیلی و ارزیابی فوریت همزمان با تحلیل بیمار محاسبه می‌شوند (هزینه بیشتر)"
+    )
+    if not st.session_state.speculation_enabled and "speculative_jobs" in st.session_state:
+        st.session_state.speculative_jobs.cancel()
+    
     st.markdown("---")
     
     # Show statistics
     st.subheader("📊 آمار جلسه")
-    st.metric("تعداد مشاورات", len(st.session_state.consultation_history))
+    consultation_count = consultation_store.count(session_id=st.session_state.history_id)
+    st.metric("تعداد مشاورات", consultation_count)
+    if consultation_store.last_error is not None:
+        st.error(
+            f"⚠️ ذخیره {consultation_store.unwritten} مشاوره ناموفق بود؛ "
+            f"تلاش مجدد ادامه دارد ({consultation_store.last_error})"
+        )
+    cache_stats = response_cache.stats()
+    st.caption(
+        f"💾 کش پاسخ‌ها: {cache_stats['hits']} موفق / {cache_stats['misses']} ناموفق "
+        f"({cache_stats['disk_size']} مورد ذخیره شده)"
+    )
+    queue_stats = get_scheduler().stats()
+    st.caption(
+        f"🚦 صف درخواست‌ها: {queue_stats['queue_depth']} در انتظار / "
+        f"{queue_stats['active']} در حال اجرا / "
+        f"{get_single_flight().stats()['calls_saved']} درخواست تکراری ادغام شده"
+    )
+    open_cases = case_queue.counts()
+    st.caption(
+        f"📥 پرونده‌های باز: {sum(open_cases.values())} "
+        f"({open_cases.get(0, 0)} فوری)"
+    )
     
     if st.session_state.patient_symptoms:
         st.success("✅ علائم ثبت شده")
@@ -324,12 +820,20 @@ with st.sidebar:
     
     # Clear history
     if st.button("🗑️ پاک کردن تاریخچه"):
-        st.session_state.consultation_history = []
+        # Only this history's rows; other patients and the shared
+        # similar-case index keep theirs (deleted rows drop out of matches)
+        consultation_store.clear(session_id=st.session_state.history_id)
+        st.session_state.pop("history_page", None)
         st.session_state.patient_symptoms = None
         st.session_state.analysis_result = None
+        st.session_state.triage_result = None
+        if "speculative_jobs" in st.session_state:
+            st.session_state.speculative_jobs.cancel()
         st.success("تاریخچه پاک شد!")
         st.rerun()
 
+rerun.lap("sidebar")
+
 # Main content area
 st.markdown("---")
 
@@ -355,110 +859,145 @@ if role == "بیمار":
         if input_method == "🎙️ ورودی صوتی":
             st.subheader("🎙️ ثبت علائم (ورودی صوتی)")
 
+            # Audio-device modules are only loaded on the voice path
+            from audio_capture import AudioCapture
+            import chunked_transcription
+
             # Voice recording workflow states
             if "is_recording" not in st.session_state:
                 st.session_state.is_recording = False
             if "audio_data" not in st.session_state:
                 st.session_state.audio_data = None
 
-            fs = 44100  # Sample rate
+            fs = int(os.getenv("RECORDING_SAMPLE_RATE", "44100"))  # Sample rate
+            max_seconds = int(os.getenv("MAX_RECORDING_SECONDS", "300"))
+            upload_format = os.getenv("AUDIO_UPLOAD_FORMAT", "wav")  # wav, flac or opus
 
             if not st.session_state.is_recording:
                 # Show the "Start Recording" button when not recording
+                rejected = st.session_state.get("recording_rejected")
+                if rejected:
+                    st.warning(rejected)
                 if st.button("🎤 شروع ضبط صدا", type="primary"):
                     st.session_state.is_recording = True
                     st.session_state.audio_data = None
+                    st.session_state.recording_rejected = None
+                    st.session_state.incremental_transcript = None
+                    start_consultation_trace()
                     st.rerun()
             else:
                 # Show the "Stop Recording" button while recording
                 status_text = st.info("🔴 در حال ضبط... برای اتمام ضبط روی دکمه زیر کلیک کنید")
 
                 # Start recording when entering recording mode
-                if "recording_started" not in st.session_state:
+                if "audio_capture" not in st.session_state:
                     try:
-                        st.session_state.audio_array = sd.rec(int(60 * fs), samplerate=fs, channels=1)
-                        st.session_state.recording_started = True
+                        transcriber = None
+                        if INCREMENTAL_TRANSCRIPTION:
+                            transcriber = chunked_transcription.IncrementalTranscriber(
+                                transcribe_audio, fs, get_transcription_executor(),
+                                # Segments are gated before upload; they have no minimum length
+                                quality_check=functools.partial(
+                                    audio_quality.check, min_seconds=0, min_speech_seconds=0
+                                )
+                            )
+                        capture = AudioCapture(
+                            samplerate=fs,
+                            max_seconds=max_seconds,
+                            on_block=transcriber.feed if transcriber else None
+                        )
+                        capture.start()
+                        st.session_state.audio_capture = capture
+                        st.session_state.transcriber = transcriber
                     except Exception as e:
-                        st.session_state.audio_array = None
                         st.session_state.is_recording = False
                         st.error(f"❌ خطا در ضبط صدا: {e}")
                         st.rerun()
                 
                 if st.button("⏹️ پایان ضبط"):
+                    capture = st.session_state.pop("audio_capture", None)
+                    transcriber = st.session_state.pop("transcriber", None)
                     try:
-                        sd.stop()
-                        # Estimate length by finding number of samples before all zeros
-                        # (Simple truncate extra silence if recording wasn't full 60s)
-                        audio = st.session_state.audio_array
-                        flat = audio.flatten()
-                        # Find where actual input stops (optional for advanced users)
-                        nonzero = (flat != 0).nonzero()[0]
-                        if len(nonzero) > 0:
-                            last_idx = nonzero[-1] + 1
-                            audio = audio[:last_idx]
-                        st.session_state.audio_data = audio
-                        st.success("✅ ضبط تمام شد!")
+                        capture.stop()
+                        metrics.observe("recording", capture.seconds)
+                        # Unusable recordings stop here, before any upload
+                        quality = check_recording(capture.get_audio(), fs)
+                        st.session_state.audio_corrections = quality.corrections
+                        if quality.problems:
+                            if transcriber is not None:
+                                transcriber.cancel()
+                            st.session_state.audio_data = None
+                            st.session_state.recording_rejected = audio_quality.rejection_message(quality.problems)
+                        else:
+                            if transcriber is not None:
+                                # Most segments are already transcribed; wait for the tail
+                                try:
+                                    with st.spinner("🔄 در حال تبدیل صوت به متن..."), \
+                                            metrics.span("transcription_finish"):
+                                        st.session_state.incremental_transcript = transcriber.finish()
+                                except Exception:
+                                    # Fall back to transcribing the whole recording, also
+                                    # when segments failed the quality check
+                                    # (chunked_transcription.SegmentsRejected)
+                                    st.session_state.incremental_transcript = None
+                            # Resample, drop silence and encode once in memory
+                            prepared, vad = prepare_recording(
+                                quality.audio, fs, container=upload_format
+                            )
+                            st.session_state.audio_data = prepared
+                            st.session_state.recording_id = uuid.uuid4().hex
+                            st.session_state.audio_vad = vad
+                            st.session_state.recording_truncated = capture.truncated
+                            st.success("✅ ضبط تمام شد!")
                     except Exception as e:
                         st.session_state.audio_data = None
                         st.error(f"❌ خطا در ضبط صدا: {e}")
                     st.session_state.is_recording = False
-                    if "recording_started" in st.session_state:
-                        del st.session_state.recording_started
-                    if "audio_array" in st.session_state:
-                        del st.session_state.audio_array
                     st.rerun()
 
             # If audio recorded, proceed to saving and processing
             if st.session_state.audio_data is not None:
-                audio = st.session_state.audio_data
-                wavio.write("user_voice.wav", audio, fs, sampwidth=2)
-                st.audio("user_voice.wav", format="audio/wav")
-                
-                # Save audio file
-                wavio.write("user_voice.wav", audio, fs, sampwidth=2)
-                st.audio("user_voice.wav", format="audio/wav")
+                prepared = st.session_state.audio_data
+                if st.session_state.get("recording_truncated"):
+                    st.warning(f"⚠️ ضبط پس از {max_seconds} ثانیه متوقف شد.")
+                st.audio(prepared.data, format=prepared.mime_type)
+                corrections = st.session_state.get("audio_corrections")
+                if corrections:
+                    st.caption("🎚️ اصلاح خودکار صدا: " + "، ".join(
+                        audio_quality.CORRECTION_MESSAGES[correction] for correction in corrections
+                    ))
+                vad = st.session_state.get("audio_vad")
+                if vad is not None:
+                    st.caption(
+                        f"🔇 {vad.seconds_removed:.1f} ثانیه سکوت حذف شد "
+                        f"(نسبت گفتار: {vad.speech_ratio:.0%})"
+                    )
                 
-                # Transcribe audio
-                try:
-                    with st.spinner("🔄 در حال تبدیل صوت به متن..."):
-                        with open("user_voice.wav", "rb") as f:
-                            transcript = client.audio.transcriptions.create(
-                                model="whisper-1",
-                                file=f,
-                                language="fa"
-                            )
-                        
-                        text = transcript.text
-                        st.session_state.patient_symptoms = text
-                        
-                        st.success(f"📝 **علائم استخراج شده:**\n\n{text}")
-                        
-                        # Analyze symptoms
-                        with st.spinner("🔍 در حال تحلیل علائم..."):
-                            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            prompt = format_prompt(
-                                PATIENT_ANALYSIS_PROMPT,
-                                symptoms=text,
-                                timestamp=timestamp
-                            )
-                            
-                            analysis = ask_model(prompt)
-                            st.session_state.analysis_result = analysis
-                            
-                            # Save to history
-                            save_consultation(text, analysis, "بیمار")
-                            
-                            st.markdown("### 📋 نتیجه تحلیل:")
-                            st.info(analysis)
-                            
-                            # Check for emergency
-                            if "🔴" in analysis or "بحرانی" in analysis or "فوری" in analysis.lower():
-                                st.error("⚠️ **هشدار:** احتمال نیاز به مراجعه فوری!")
-                                if st.button("📞 تماس با اورژانس 115"):
-                                    st.error("لطفاً فوراً با شماره 115 تماس بگیرید")
-                    
-                except Exception as e:
-                    st.error(f"❌ خطا در پردازش صوت: {e}")
+                recording_id = st.session_state.get("recording_id")
+                if st.session_state.get("analysed_recording") == recording_id:
+                    # Already transcribed and analysed; later reruns only redisplay it
+                    st.success(f"📝 **علائم استخراج شده:**\n\n{st.session_state.patient_symptoms}")
+                    if st.session_state.analysis_result:
+                        show_patient_analysis("emergency_voice")
+                else:
+                    # Transcribe audio
+                    try:
+                        with st.spinner("🔄 در حال تبدیل صوت به متن..."):
+                            text = st.session_state.get("incremental_transcript")
+                            if not text:
+                                text = transcribe_audio(prepared)
+                            st.session_state.patient_symptoms = text
+                            # Publish and save once per recording, even if the analysis fails
+                            st.session_state.analysed_recording = recording_id
+
+                            st.success(f"📝 **علائم استخراج شده:**\n\n{text}")
+
+                            # Analyze symptoms
+                            with st.spinner("🔍 در حال تحلیل علائم..."):
+                                analyze_patient_symptoms(text, "emergency_voice")
+
+                    except Exception as e:
+                        st.error(f"❌ خطا در پردازش صوت: {e}")
         
         elif input_method == "⌨️ ورودی متنی":
             st.subheader("⌨️ ثبت علائم (ورودی متنی)")
@@ -476,34 +1015,23 @@ if role == "بیمار":
                 if text_input.strip():
                     text = text_input.strip()
                     st.session_state.patient_symptoms = text
+                    start_consultation_trace()
                     
                     st.success(f"📝 **علائم ثبت شده:**\n\n{text}")
                     
                     # Analyze symptoms
                     with st.spinner("🔍 در حال تحلیل علائم..."):
-                        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        prompt = format_prompt(
-                            PATIENT_ANALYSIS_PROMPT,
-                            symptoms=text,
-                            timestamp=timestamp
-                        )
-                        
-                        analysis = ask_model(prompt)
-                        st.session_state.analysis_result = analysis
-                        
-                        # Save to history
-                        save_consultation(text, analysis, "بیمار")
-                        
-                        st.markdown("### 📋 نتیجه تحلیل:")
-                        st.info(analysis)
-                        
-                        # Check for emergency
-                        if "🔴" in analysis or "بحرانی" in analysis or "فوری" in analysis.lower():
-                            st.error("⚠️ **هشدار:** احتمال نیاز به مراجعه فوری!")
-                            if st.button("📞 تماس با اورژانس 115", key="emergency_text"):
-                                st.error("لطفاً فوراً با شماره 115 تماس بگیرید")
+                        analyze_patient_symptoms(text, "emergency_text")
                 else:
                     st.warning("⚠️ لطفاً علائم خود را وارد کنید")
+            elif st.session_state.analysis_result and \
+                    st.session_state.patient_symptoms == text_input.strip():
+                show_patient_analysis("emergency_text")
+        
+        # Patient answers go back into the assessment through a follow-up conversation
+        analysis = st.session_state.analysis_result
+        if st.session_state.patient_symptoms and analysis and not is_model_error(analysis):
+            render_follow_up_conversation()
     
     with col2:
         st.subheader("📌 راهنمای سریع")
@@ -550,17 +1078,80 @@ elif role == "پزشک":
     
     st.subheader("👨‍⚕️ پنل پزشک - تحلیل و پیگیری")
     
+    render_case_queue()
+    st.markdown("---")
+    
+    claimed_case = st.session_state.get("claimed_case")
+    if claimed_case is not None:
+        st.info(f"📂 پرونده #{claimed_case} در دست بررسی شماست")
+        done_col, release_col = st.columns(2)
+        with done_col:
+            finished = st.button("✅ پایان بررسی پرونده")
+        with release_col:
+            released = st.button("↩️ بازگرداندن به صف")
+        if finished or released:
+            if finished:
+                case_queue.close(claimed_case, st.session_state.session_id)
+            else:
+                case_queue.release(claimed_case, st.session_state.session_id)
+            st.session_state.claimed_case = None
+            st.session_state.patient_symptoms = None
+            st.session_state.analysis_result = None
+            st.session_state.triage_result = None
+            st.rerun()
+    
     if st.session_state.patient_symptoms is None:
         st.warning("⏳ در انتظار ثبت علائم توسط بیمار")
-        st.info("لطفاً ابتدا بیمار باید علائم خود را در بخش مربوطه ثبت کند.")
+        st.info("یک پرونده را از صف بیماران بردارید یا منتظر ثبت علائم توسط بیمار بمانید.")
     else:
         # Display patient symptoms
         st.success(f"✅ **علائم ثبت شده بیمار:**\n\n{st.session_state.patient_symptoms}")
+        flags = red_flag_matcher.match(st.session_state.patient_symptoms)
+        if flags:
+            show_red_flag_alert(flags)
+        doctor_priority = "red_flag" if flags else "follow_up"
+        
+        # Past handling of similar cases, from the local index (no model call);
+        # the case's own stored consultation is the one the doctor can approve
+        matches = similar_consultations(st.session_state.patient_symptoms, k=6)
+        stored = next((
+            past for past, _ in matches
+            if past.symptoms == st.session_state.patient_symptoms and past.role == "بیمار"
+        ), None)
         
         # Show initial analysis if available
         if st.session_state.analysis_result:
             with st.expander("📊 مشاهده تحلیل اولیه", expanded=False):
-                st.info(st.session_state.analysis_result)
+                if st.session_state.triage_result is not None:
+                    render_triage(st.session_state.triage_result)
+                else:
+                    st.info(st.session_state.analysis_result)
+                if stored is not None:
+                    review_checkbox(stored, f"case_reviewed_{stored.id}")
+        
+        conversation = st.session_state.get("conversation")
+        if conversation is not None and conversation.symptoms == st.session_state.patient_symptoms \
+                and conversation.turns:
+            with st.expander("💬 گفتگوی پیگیری بیمار", expanded=False):
+                if conversation.summary:
+                    st.markdown("**خلاصه بخش‌های قبلی:**")
+                    st.info(conversation.summary)
+                st.markdown(format_turns(conversation.recent()).replace("\n", "  \n"))
+        
+        similar = [
+            (past, score) for past, score in matches
+            if past.symptoms != st.session_state.patient_symptoms
+        ][:5]
+        if similar:
+            with st.expander(f"🔎 موارد مشابه قبلی ({len(similar)})", expanded=False):
+                for past, score in similar:
+                    level = f" · {TRIAGE_LEVELS[past.triage]}" if past.triage else ""
+                    reviewed = " · ✅ تأیید شده" if past.reviewed else ""
+                    st.markdown(f"**شباهت {score:.0%}** · {past.timestamp}{level}{reviewed}  \n{past.symptoms}")
+                    if st.toggle("📄 نمایش تحلیل", key=f"similar_analysis_{past.id}"):
+                        st.info(consultation_store.get_analysis(past.id)[0])
+                    if past.role == "بیمار":
+                        review_checkbox(past, f"similar_reviewed_{past.id}")
         
         st.markdown("---")
         
@@ -574,9 +1165,8 @@ elif role == "پزشک":
                         DOCTOR_QUESTIONS_PROMPT,
                         symptoms=st.session_state.patient_symptoms
                     )
-                    questions = ask_model(prompt)
                     st.markdown("### 📝 سوالات تکمیلی برای بیمار:")
-                    st.info(questions)
+                    questions = render_doctor_answer("questions", prompt, priority=doctor_priority)
         
         with col2:
             if st.button("🚨 بررسی فوریت"):
@@ -585,30 +1175,62 @@ elif role == "پزشک":
                         EMERGENCY_PROTOCOL,
                         symptoms=st.session_state.patient_symptoms
                     )
-                    emergency = ask_model(prompt)
                     st.markdown("### 🚨 ارزیابی فوریت:")
-                    st.warning(emergency)
+                    emergency = render_doctor_answer("emergency", prompt, box="warning", priority=doctor_priority)
         
         with col3:
             if st.button("📄 تولید گزارش کامل"):
-                st.info("🔄 در حال تولید گزارش جامع...")
-                # This would generate a comprehensive report
-                st.success("✅ گزارش در دست تهیه است...")
+                # Runs in the background
+                submit_report(doctor_priority)
+        
+        report_case, report_job_id = st.session_state.get("report_job", (None, None))
+        if report_case == case_key(st.session_state.patient_symptoms):
+            render_report(report_job_id, doctor_priority)
+
+rerun.lap(ROLE_SECTIONS.get(role, "main"))
 
 # ============================================
 # CONSULTATION HISTORY
 # ============================================
 
-if st.session_state.consultation_history:
+# Recount: this rerun may have just saved a consultation
+consultation_count = consultation_store.count(session_id=st.session_state.history_id)
+if consultation_count:
     st.markdown("---")
     st.subheader("📚 تاریخچه مشاورات")
     
-    for i, consultation in enumerate(reversed(st.session_state.consultation_history)):
-        with st.expander(f"مشاوره #{len(st.session_state.consultation_history) - i} - {consultation['timestamp']}"):
-            st.markdown(f"**نقش:** {consultation['role']}")
-            st.markdown(f"**علائم:** {consultation['symptoms']}")
-            st.markdown("**تحلیل:**")
-            st.info(consultation['analysis'])
+    page_count = -(-consultation_count // HISTORY_PAGE_SIZE)
+    page = 1
+    if page_count > 1:
+        if st.session_state.get("history_page", 1) > page_count:
+            st.session_state.history_page = page_count
+        page = st.number_input(
+            f"صفحه (از {page_count})",
+            min_value=1,
+            max_value=page_count,
+            step=1,
+            key="history_page"
+        )
+    
+    # Only the visible page is loaded; analyses stay in the store until asked for
+    for offset, consultation in enumerate(consultation_store.page(
+            page - 1, HISTORY_PAGE_SIZE, session_id=st.session_state.history_id)):
+        number = consultation_count - (page - 1) * HISTORY_PAGE_SIZE - offset
+        with st.expander(f"مشاوره #{number} - {consultation.timestamp}"):
+            st.markdown(f"**نقش:** {consultation.role}")
+            if consultation.triage:
+                st.markdown(f"**سطح فوریت:** {TRIAGE_LEVELS[consultation.triage]}")
+            st.markdown(f"**علائم:** {consultation.symptoms}")
+            # Streamlit renders expander bodies even when collapsed, so the
+            # analysis is fetched only once the reader asks for it
+            if st.toggle("📄 نمایش تحلیل", key=f"history_analysis_{consultation.id}"):
+                analysis, _ = consultation_store.get_analysis(consultation.id)
+                st.markdown("**تحلیل:**")
+                st.info(analysis)
+            if role == "پزشک" and consultation.role == "بیمار":
+                review_checkbox(consultation, f"history_reviewed_{consultation.id}")
+
+rerun.lap("history")
 
 # ============================================
 # FOOTER
@@ -621,4 +1243,12 @@ st.markdown("""
     <p>⚠️ این سیستم فقط برای مشاوره اولیه است و جایگزین ویزیت پزشک نمی‌شود</p>
     <p>🔒 اطلاعات شما محرمانه و امن نگهداری می‌شود</p>
 </div>
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)
+
+rerun.lap("footer")
+rerun.finish()
+
+if rerun_profiler.enabled:
+    with st.sidebar:
+        with st.expander("⏱️ زمان اجرای بخش‌ها (میلی‌ثانیه)"):
+            st.table(rerun_profiler.stats())